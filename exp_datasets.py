@@ -8,6 +8,7 @@ import urllib
 from abc import ABC, abstractmethod
 
 import itertools
+import numpy as np
 import pandas as pd
 
 
@@ -37,6 +38,7 @@ class LampDataset(Dataset):
         self.split = split
         self.data_split = data_split
         self.tag = f"lamp_{self.num}_{self.data_split}_{self.split}"
+        self.cache_tag = self.tag
         self.dataset_dir = os.path.join("files", dataset_dir)
         os.makedirs(self.dataset_dir, exist_ok=True)
         self.dataset = None
@@ -143,6 +145,13 @@ class LampDataset(Dataset):
         data = self.get_dataset()
         return [i["id"] for i in data]
 
+    def filter_profiles(self, kept_idxs, filter_tag):
+        if not self.dataset:
+            self.dataset = self.get_dataset()
+        for sample, kept in zip(self.dataset, kept_idxs):
+            sample["profile"] = [sample["profile"][j] for j in kept]
+        self.cache_tag = f"{self.tag}_{filter_tag}"
+
 
 class AmazonDataset(Dataset):
 
@@ -152,9 +161,12 @@ class AmazonDataset(Dataset):
         self.year = year
         self.dataset = None
         self.tag = f"amazon_{self.category}_{self.year}"
+        self.cache_tag = self.tag
         self.dataset_dir = os.path.join("files", dataset_dir)
         os.makedirs(self.dataset_dir, exist_ok=True)
         self.min_user_samples = 20
+        self.rating_arrays = None
+        self.rating_buckets = None
 
     def get_dataset(self):
 
@@ -253,6 +265,34 @@ class AmazonDataset(Dataset):
             self.dataset = self.get_dataset()
         return self.dataset[idx]["Product"]["Score"], [item["Score"] for item in self.dataset[idx]["History"]]
 
+    def filter_profiles(self, kept_idxs, filter_tag):
+        if not self.dataset:
+            self.dataset = self.get_dataset()
+        for sample, kept in zip(self.dataset, kept_idxs):
+            sample["History"] = [sample["History"][j] for j in kept]
+        self.cache_tag = f"{self.tag}_{filter_tag}"
+        self.rating_arrays = None
+        self.rating_buckets = None
+
+    def get_rating_arrays(self):
+        if self.rating_arrays is None:
+            if not self.dataset:
+                self.dataset = self.get_dataset()
+            query_ratings = np.array([sample["Product"]["Score"] for sample in self.dataset])
+            doc_ratings = [np.array([item["Score"] for item in sample["History"]]) for sample in self.dataset]
+            self.rating_arrays = query_ratings, doc_ratings
+        return self.rating_arrays
+
+    def get_rating_buckets(self):
+        if self.rating_buckets is None:
+            _, doc_ratings = self.get_rating_arrays()
+            self.rating_buckets = []
+            for ratings in doc_ratings:
+                order = np.argsort(ratings, kind="stable")
+                values, starts = np.unique(ratings[order], return_index=True)
+                self.rating_buckets.append(dict(zip(values.tolist(), np.split(order, starts[1:]))))
+        return self.rating_buckets
+
     def get_statistics(self):
 
         _, _, retr_gts = self.get_retr_data()
@@ -1,9 +1,13 @@
 import configparser
 import os
+from bisect import bisect_right
+from itertools import accumulate
 from pathlib import Path
 import warnings
 warnings.filterwarnings("ignore")
 
+import torch
+
 from huggingface_hub import login, logging, hf_hub_download
 logging.set_verbosity_error()
 import tiktoken
@@ -14,10 +18,16 @@ from openai import OpenAI
 from anthropic import Anthropic
 import google.generativeai as genai
 
+from utils.continuous_batching import ContinuousBatchingEngine, SAMPLING_DEFAULTS
+from utils.prefix_cache import PrefixCache
+from utils.async_client import AsyncLLMClient
+from utils.response_cache import ResponseCache
+from utils.token_estimator import TokenEstimator
+
 
 class LLM:
 
-    def __init__(self, model_name, model_params=None, gen_params=None) -> None:
+    def __init__(self, model_name, model_params=None, gen_params=None, use_cache=True, token_margin=0.1) -> None:
         
         login(token=os.getenv("HF_API_KEY"), new_session=False)
         self.cfg = self.get_model_cfg()[model_name]
@@ -31,6 +41,12 @@ class LLM:
         self.model_params = self.get_model_params(model_params)
         self.gen_params = self.get_gen_params(gen_params)
         self.model = self.init_model()
+        self.pipe = None
+        self.prefix_cache = None
+        self.response_cache = ResponseCache() if use_cache else None
+        self.encoding = None
+        self.doc_token_counts = {}
+        self.token_estimator = TokenEstimator(self.family, token_margin) if self.family in ["GEMINI", "CLAUDE"] else None
 
     def get_model_cfg(self):
 
@@ -45,6 +61,41 @@ class LLM:
         else:
             gen_params = self.get_gen_params(gen_params)
 
+        mode = "prefix" if self.prefix_cache is not None else "pipeline"
+        return self.cached_responses([prompt], gen_params, lambda prompts: [self.generate_response(prompts[0], gen_params)], mode)[0]
+
+    def get_cache_params(self, gen_params, mode):
+
+        if not self.is_local():
+            return {"mode": "api", **gen_params}
+        if mode == "continuous":
+            return {"mode": mode, self.name_token_var: gen_params[self.name_token_var], **self.get_sampling_params(gen_params)}
+        generation_config = getattr(self.model, "generation_config", None)
+        config = generation_config.to_diff_dict() if generation_config is not None else {}
+        config.pop("transformers_version", None)
+        return {"mode": mode, **config, **gen_params}
+
+    def cached_responses(self, prompts, gen_params, generate_fn, mode):
+
+        if self.response_cache is None:
+            responses = generate_fn(prompts)
+        else:
+            cache_params = self.get_cache_params(gen_params, mode)
+            keys = [self.response_cache.make_key(self.repo_id, cache_params, prompt) for prompt in prompts]
+            responses = [self.response_cache.get(key) for key in keys]
+            missing = [i for i, response in enumerate(responses) if response is None]
+            if missing:
+                for i, response in zip(missing, generate_fn([prompts[i] for i in missing])):
+                    responses[i] = response
+                    self.response_cache.put(keys[i], response)
+        errors = [response for response in responses if isinstance(response, Exception)]
+        if errors:
+            print(f"{len(errors)} of {len(prompts)} requests failed!")
+            raise errors[0]
+        return responses
+
+    def generate_response(self, prompt, gen_params):
+
         if self.model_type in ["PPLX", "GROQ", "TGTR"] or self.family == "GPT":
 
             response = self.model.chat.completions.create(model=self.repo_id, messages=prompt, **gen_params)
@@ -52,38 +103,174 @@ class LLM:
 
         elif self.family == "CLAUDE":
 
-            if len(prompt) > 1:
-                sys_msg = prompt[0]["content"]
-                prompt = [prompt[1]]
-                response = self.model.messages.create(model=self.repo_id, messages=prompt, system=sys_msg, **gen_params)
+            messages, sys_msg = self.claude_messages(prompt)
+            if sys_msg is not None:
+                response = self.model.messages.create(model=self.repo_id, messages=messages, system=sys_msg, **gen_params)
 
             else:
-                response = self.model.messages.create(model=self.repo_id, messages=prompt, **gen_params)
+                response = self.model.messages.create(model=self.repo_id, messages=messages, **gen_params)
             response = response.content[0].text   
 
         elif self.family == "GEMINI":
 
-            messages = []
-            for turn in prompt:
-                role = "user" if turn["role"] in ["user", "system"] else "model"
-                messages.append({
-                    "role": role,
-                    "parts": [turn["content"]]
-                })
-            response = self.model.generate_content(messages, generation_config=genai.types.GenerationConfig(**gen_params))
+            response = self.model.generate_content(self.gemini_messages(prompt), generation_config=genai.types.GenerationConfig(**gen_params))
             response = response.text 
 
-        else:
+        elif self.prefix_cache is not None:
+
+            response = self.generate_from_cache(self.encode_chat([prompt])[0], gen_params, self.prefix_cache)
 
-            if self.family in ["MISTRAL", "GEMMA"]:
-                if len(prompt) > 1:
-                    prompt = [{"role": "user", "content": "\n".join([turn["content"] for turn in prompt])}]
+        else:
 
-            pipe = pipeline("text-generation", model=self.model, tokenizer=self.tokenizer, **gen_params)
-            response = pipe(prompt)[0]["generated_text"][-1]["content"]
+            response = self.get_pipeline()(self.merge_turns(prompt), **gen_params)[0]["generated_text"][-1]["content"]
 
         return response
 
+    def claude_messages(self, prompt):
+
+        if len(prompt) > 1:
+            return [prompt[1]], prompt[0]["content"]
+        return prompt, None
+
+    def gemini_messages(self, prompt):
+
+        messages = []
+        for turn in prompt:
+            role = "user" if turn["role"] in ["user", "system"] else "model"
+            messages.append({
+                "role": role,
+                "parts": [turn["content"]]
+            })
+        return messages
+
+    def prompt_concurrent(self, prompts, gen_params=None, concurrency=8, rpm=None, tpm=None, base_url=None):
+
+        if self.is_local():
+            return self.prompt_batch(prompts, gen_params, batch_size=concurrency)
+
+        gen_params = self.gen_params if not gen_params else self.get_gen_params(gen_params)
+        client = AsyncLLMClient(self, concurrency=concurrency, rpm=rpm, tpm=tpm, base_url=base_url)
+        return self.cached_responses(prompts, gen_params, lambda missing: client.run(missing, gen_params), "api")
+
+    def is_local(self):
+
+        return not (self.model_type in ["PPLX", "GROQ", "TGTR"] or self.family in ["GPT", "CLAUDE", "GEMINI"])
+
+    def merge_turns(self, prompt):
+
+        if self.family in ["MISTRAL", "GEMMA"] and len(prompt) > 1:
+            return [{"role": "user", "content": "\n".join([turn["content"] for turn in prompt])}]
+        return prompt
+
+    def supports_prefix_cache(self):
+
+        return getattr(self.model.generation_config, "cache_implementation", None) is None
+
+    def set_prefix_cache(self, prefix, marker="<PREFIX_END>"):
+
+        if not self.is_local():
+            return None
+        if not self.supports_prefix_cache():
+            print(f"{self.model_name} uses a {self.model.generation_config.cache_implementation} cache, generating without the prefix cache!")
+            return None
+        text = self.tokenizer.apply_chat_template(self.merge_turns([{"role": "user", "content": f"{prefix}{marker}"}]), tokenize=False, add_generation_prompt=True)
+        prefix_ids = self.tokenizer(text[:text.index(marker)], add_special_tokens=False).input_ids[:-1]
+        self.prefix_cache = PrefixCache(self.model, prefix_ids)
+        return len(self.prefix_cache)
+
+    def generate_from_cache(self, input_ids, gen_params, prefix_cache):
+
+        inputs = torch.tensor([input_ids], device=self.model.device)
+        pad_token_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
+        past_key_values = prefix_cache.get(prefix_cache.match(input_ids)) if prefix_cache is not None else None
+        with torch.no_grad():
+            outputs = self.model.generate(input_ids=inputs, attention_mask=torch.ones_like(inputs), past_key_values=past_key_values,
+                                          pad_token_id=pad_token_id, **gen_params)
+        return self.tokenizer.decode(outputs[0, len(input_ids):], skip_special_tokens=True).strip()
+
+    def prompt_sweep(self, prompts, gen_params=None):
+
+        if not self.is_local():
+            return [self.prompt_chatbot(prompt, gen_params) for prompt in prompts]
+
+        gen_params = self.gen_params if not gen_params else self.get_gen_params(gen_params)
+        return self.cached_responses(prompts, gen_params, lambda missing: self.generate_sweep(missing, gen_params), "sweep")
+
+    def generate_sweep(self, prompts, gen_params):
+
+        all_input_ids = self.encode_chat(prompts)
+        if not self.supports_prefix_cache():
+            return [self.generate_from_cache(input_ids, gen_params, None) for input_ids in all_input_ids]
+        sweep_cache = PrefixCache(self.model, max(all_input_ids, key=len), base=self.prefix_cache)
+        return [self.generate_from_cache(input_ids, gen_params, sweep_cache) for input_ids in all_input_ids]
+
+    def get_pipeline(self):
+
+        if self.pipe is None:
+            self.pipe = pipeline("text-generation", model=self.model, tokenizer=self.tokenizer)
+        return self.pipe
+
+    def prompt_batch(self, prompts, gen_params=None, batch_size=8):
+
+        if not self.is_local():
+            return [self.prompt_chatbot(prompt, gen_params) for prompt in prompts]
+
+        gen_params = self.gen_params if not gen_params else self.get_gen_params(gen_params)
+        return self.cached_responses(prompts, gen_params, lambda missing: self.generate_batch(missing, gen_params, batch_size), "batch")
+
+    def generate_batch(self, prompts, gen_params, batch_size):
+
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.tokenizer.padding_side = "left"
+
+        input_ids = self.encode_chat(prompts)
+        order = sorted(range(len(prompts)), key=lambda i: len(input_ids[i]), reverse=True)
+
+        responses = [None] * len(prompts)
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start+batch_size]
+            inputs = self.tokenizer.pad({"input_ids": [input_ids[i] for i in batch]}, padding=True, return_tensors="pt").to(self.model.device)
+            with torch.no_grad():
+                outputs = self.model.generate(**inputs, pad_token_id=self.tokenizer.pad_token_id, **gen_params)
+            decoded = self.tokenizer.batch_decode(outputs[:, inputs["input_ids"].shape[1]:], skip_special_tokens=True)
+            for i, response in zip(batch, decoded):
+                responses[i] = response.strip()
+        return responses
+
+    def encode_chat(self, prompts):
+
+        texts = [self.tokenizer.apply_chat_template(self.merge_turns(prompt), tokenize=False, add_generation_prompt=True) for prompt in prompts]
+        return self.tokenizer(texts, add_special_tokens=False).input_ids
+
+    def prompt_continuous(self, prompts, gen_params=None, max_batch_size=8, max_tokens_in_flight=16384):
+
+        if not self.is_local():
+            return [self.prompt_chatbot(prompt, gen_params) for prompt in prompts]
+
+        gen_params = self.gen_params if not gen_params else self.get_gen_params(gen_params)
+        return self.cached_responses(prompts, gen_params, lambda missing: self.generate_continuous(missing, gen_params, max_batch_size, max_tokens_in_flight), "continuous")
+
+    def get_sampling_params(self, gen_params):
+
+        sampling_params = {}
+        for name, default in SAMPLING_DEFAULTS.items():
+            value = gen_params.get(name, getattr(self.model.generation_config, name, None))
+            sampling_params[name] = default if value is None else value
+        return sampling_params
+
+    def generate_continuous(self, prompts, gen_params, max_batch_size, max_tokens_in_flight):
+
+        unsupported = sorted(set(gen_params) - set(SAMPLING_DEFAULTS) - {self.name_token_var})
+        if unsupported:
+            raise ValueError(f"Continuous batching does not support generation parameters {unsupported}!")
+        eos_token_ids = self.model.generation_config.eos_token_id
+        if eos_token_ids is None:
+            eos_token_ids = self.tokenizer.eos_token_id
+        engine = ContinuousBatchingEngine(self.model, eos_token_ids, max_batch_size, max_tokens_in_flight, self.prefix_cache, **self.get_sampling_params(gen_params))
+        outputs = engine.generate(self.encode_chat(prompts), gen_params[self.name_token_var])
+        return [self.tokenizer.decode(output_ids, skip_special_tokens=True).strip() for output_ids in outputs]
+
     def get_avail_space(self, prompt):
 
         avail_space = self.context_length - self.gen_params[self.name_token_var] - self.count_tokens(prompt)
@@ -101,19 +288,29 @@ class LLM:
             total_hist_tokens -= self.count_tokens(removed_message['content'])
         return chat_history 
        
-    def count_tokens(self, prompt):
+    def count_tokens(self, prompt, exact=False):
 
         if isinstance(prompt, list):
             prompt = "\n".join([turn["content"] for turn in prompt])
         if self.family == "GPT":
-            encoding = tiktoken.encoding_for_model(self.repo_id)
-            return len(encoding.encode(prompt))
+            return len(self.get_encoding().encode(prompt))
+        elif self.token_estimator is not None and not exact:
+            return self.token_estimator.estimate(prompt)
         elif self.family == "GEMINI":
             return self.model.count_tokens(prompt).total_tokens
         elif self.family == "CLAUDE":
-            return self.model.count_tokens(prompt)
+            if hasattr(self.model, "count_tokens"):
+                return self.model.count_tokens(prompt)
+            return self.model.messages.count_tokens(model=self.repo_id, messages=[{"role": "user", "content": prompt}]).input_tokens
         else:
             return len(self.tokenizer(prompt).input_ids)
+
+    def calibrate_token_estimator(self, texts):
+
+        if self.token_estimator is None:
+            return None
+        counts = [self.count_tokens(text, exact=True) for text in texts]
+        return self.token_estimator.calibrate(texts, counts)
         
     def prepare_context(self, prompt, context, query=None, chat_history=[]):
 
@@ -122,18 +319,45 @@ class LLM:
         if isinstance(prompt, str):
             prompt = [{"role": "user", "content": prompt}]
         query_len = self.count_tokens(query) if query else 0
-        avail_space = self.get_avail_space(prompt + chat_history) - query_len  
+        avail_space = self.get_avail_space(prompt + chat_history)
+        if avail_space is None:
+            return -1
+        avail_space = avail_space - query_len
         if avail_space:         
-            while True:
-                info = "\n".join([doc for doc in context])
-                if self.count_tokens(info) > avail_space:
-                    print("Context exceeds context window, removing one document!")
-                    context = context[:-1]
-                else:
-                    break
-            return info
+            info = "\n".join([doc for doc in context])
+            if self.count_tokens(info) <= avail_space:
+                return info
+            num_docs = self.fit_documents(context, avail_space)
+            print(f"Context exceeds context window, removing {len(context) - num_docs} documents!")
+            return "\n".join([doc for doc in context[:num_docs]])
         else:
             return -1
+
+    def get_encoding(self):
+
+        if self.encoding is None:
+            self.encoding = tiktoken.encoding_for_model(self.repo_id)
+        return self.encoding
+
+    def count_doc_tokens(self, docs):
+
+        for doc in docs:
+            if doc not in self.doc_token_counts:
+                self.doc_token_counts[doc] = self.count_tokens(doc)
+        return [self.doc_token_counts[doc] for doc in docs]
+
+    def fit_documents(self, context, avail_space):
+
+        prefix_tokens = list(accumulate(num_tokens + 1 for num_tokens in self.count_doc_tokens(context)))
+        num_docs = bisect_right(prefix_tokens, avail_space + 1)
+        if num_docs > 0 and self.count_tokens("\n".join(context[:num_docs])) > avail_space:
+            num_docs -= 1
+            while num_docs > 0 and self.count_tokens("\n".join(context[:num_docs])) > avail_space:
+                num_docs -= 1
+        else:
+            while num_docs < len(context) and self.count_tokens("\n".join(context[:num_docs+1])) <= avail_space:
+                num_docs += 1
+        return num_docs
         
     def get_model_type(self):
 
@@ -10,7 +10,8 @@ from openai import OpenAI
 from models import LLM
 from prompts import get_BFI_prompts
 from utils.argument_parser import parse_args
-from utils.file_utils import oai_get_or_create_file
+from utils.file_utils import oai_get_or_create_file, get_exp_name, get_retrieval_tag
+from utils.encoder_backends import resolve_backend
 from utils.misc import get_model_list
 
 pred_path = os.path.join("files", "preds")
@@ -33,11 +34,12 @@ if bfi_model.endswith("70B"):
             "bnb_4bit_use_double_quant": True
         }
     }
-llm = LLM(model_name=bfi_model, model_params=model_params)
+llm = LLM(model_name=bfi_model, model_params=model_params, use_cache=args.response_cache, token_margin=args.token_margin)
 
 all_models = get_model_list() + ["UP"]
 
 _, retr_texts, retr_gts = dataset.get_retr_data() 
+retrieval_tag = get_retrieval_tag(args.retriever, resolve_backend(args.retr_backend), args.cascade_m, args.embed_compression, rating_window=args.rating_window)
 print(f"Number of users: {len(retr_texts)}")
 
 for model_name in all_models:
@@ -45,7 +47,7 @@ for model_name in all_models:
     if model_name == "UP":
         exp_name = f"{dataset.tag}_{model_name}"
     else:
-        exp_name = f"{dataset.tag}_{model_name}_{final_feature_list}_{args.retriever}_RS({args.repetition_step})_K({k})"
+        exp_name = get_exp_name(args, dataset.tag, model_name, final_feature_list, retrieval_tag, k)
 
     print(exp_name)
     pred_out_path = os.path.join(pred_path, f"{exp_name}.json")
@@ -96,7 +98,7 @@ for model_name in all_models:
                 reviews = [f"\nReview: {review}\nRating: {rating}\n" for review, rating in zip(reviews, ratings)]
 
             max_k = 10 if len(reviews) > 10 else len(reviews)
-            reviews = np.random.choice(reviews, size=max_k, replace=False)
+            reviews = np.random.default_rng(i).choice(reviews, size=max_k, replace=False)
             context = llm.prepare_context(get_BFI_prompts(dataset, text=""), reviews)
 
         else:
@@ -131,6 +133,20 @@ for model_name in all_models:
             completion_window="24h",
         )
 
+    elif args.concurrency > 1:
+
+        for start_index in range(len(bfi_results), len(all_prompts), 500):
+
+            responses = llm.prompt_concurrent(all_prompts[start_index:start_index+500], gen_params={"max_tokens": MAX_NEW_TOKENS, "temperature": TEMPERATURE}, concurrency=args.concurrency)
+            bfi_results.extend(responses)
+
+            print(f"Step: {len(bfi_results)}")
+            with open(bfi_out_path, "w") as f:
+                json.dump(bfi_results, f)
+            sys.stdout.flush()
+
+        print("Finished experiment!")
+
     else:
         
         start_index = copy.copy(len(bfi_results))
@@ -151,4 +167,7 @@ for model_name in all_models:
         print("Finished experiment!")
 
         with open(bfi_out_path, "w") as f:
-            json.dump(bfi_results, f)
\ No newline at end of file
+            json.dump(bfi_results, f)
+
+if llm.response_cache is not None:
+    print(f"Response cache: {llm.response_cache.stats()}")
\ No newline at end of file
@@ -1,10 +1,6 @@
 def prepare_res_prompt(dataset, query, llm, examples, features=None, counter_examples=None, repetition_step=1, prompt_style="regular"):
 
-    if dataset.name == "lamp":
-        init_prompt = get_lamp_prompts(dataset.num, repetition_step)
-        
-    elif dataset.name == "amazon":
-        init_prompt = get_amazon_prompts(prompt_style)
+    init_prompt = get_init_prompt(dataset, repetition_step, prompt_style)
     
     feat_values = ""
     if features:
@@ -24,6 +20,21 @@ def prepare_res_prompt(dataset, query, llm, examples, features=None, counter_exa
     return init_prompt.format(query=query, examples=context, features=feat_values, counter_examples=ce_examples)
 
 
+def get_init_prompt(dataset, repetition_step=1, prompt_style="regular"):
+
+    if dataset.name == "lamp":
+        return get_lamp_prompts(dataset.num, repetition_step)
+        
+    elif dataset.name == "amazon":
+        return get_amazon_prompts(prompt_style)
+
+
+def get_prompt_prefix(dataset, repetition_step=1, prompt_style="regular"):
+
+    init_prompt = get_init_prompt(dataset, repetition_step, prompt_style)
+    return init_prompt[:init_prompt.index("{")]
+
+
 def get_BFI_prompts(dataset, text):
 
     if dataset.name == "amazon":
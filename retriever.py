@@ -1,95 +1,582 @@
 import os
-import json
+import atexit
+from collections import Counter
 
 import numpy as np
 from typing import List
 
 from sentence_transformers import SentenceTransformer
 
+from utils.embedding_store import EmbeddingStore
+from utils.ann_index import IVFIndex, recall_at_k, kmeans
+from utils.similarity import SimilarityEngine
+from utils.retrieval_cache import RetrievalCache
+from utils.encoder_backends import get_device, resolve_backend, quantize_int8, OnnxEncoder
+from utils.bm25 import BM25Index
+from utils.quantization import ProductQuantizer, compressed_nbytes
+from utils.file_utils import get_retrieval_tag
+
 
 class Retriever:
 
-    def __init__(self, dataset, model: str = "contriever", device: str = "cuda:0"):
+    def __init__(self, dataset, model: str = "contriever", device: str = None, backend: str = "torch", batch_size: int = 256, bucket_size: int = 8192, save_every: int = 500, use_store: bool = True, ce_mode: str = "exact", n_probe: int = 8, n_clusters: int = None, cluster_on: str = "query", block_size: int = 1024, num_threads: int = 1, k_max: int = 50, cascade_m: int = None, num_workers: int = None, compression: str = None, pq_subspaces: int = 16, pq_train_size: int = 65536, rating_window: int = None):
 
         self.model = model
-        self.device = device
+        self.device = get_device(device)
+        self.backend = self._resolve_backend(backend)
+        self.encoder_tag = self.model if self.backend == "torch" else f"{self.model}-{self.backend}"
         self.dataset = dataset
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.save_every = save_every
+        self.k_max = k_max
+        self.cascade_m = cascade_m if self.model != "bm25" else None
+        if compression not in [None, "fp16", "pq"]:
+            raise ValueError(f"Unknown embedding compression: {compression}")
+        self.compression = compression if self.model != "bm25" else None
+        self.pq_subspaces = pq_subspaces
+        self.pq_train_size = pq_train_size
+        self.pq = None
+        self.code_store = None
+        if rating_window is not None and not hasattr(dataset, "get_rating_buckets"):
+            raise ValueError("Rating-filtered retrieval is only available for Amazon datasets!")
+        self.rating_window = rating_window
+        self.ce_mode = ce_mode
+        self.n_probe = n_probe
+        self.n_clusters = n_clusters
+        self.cluster_on = cluster_on
+        self.engine = SimilarityEngine(block_size=block_size, num_threads=num_threads)
+        self.retrieval_tag = get_retrieval_tag(self.model, self.backend, self.cascade_m, self.compression, self.pq_subspaces, self.rating_window)
         self.save_loc = os.path.join("files", "retrieval_res")
         os.makedirs(self.save_loc, exist_ok=True)
+        self.bm25_index = None
+        self.query_index = None
+        self.repeated_docs = None
+        self.repeated_embeds = {}
+        self.num_workers = num_workers
+        self.pool = None
+        self.chosen_ks = []
+        self.sweep_ks = {}
         self._init_model()
+        if use_store and self.retr_model is not None:
+            if self.compression == "fp16":
+                self.embed_store = EmbeddingStore(f"{self.encoder_tag}-fp16", dtype="float16")
+            else:
+                self.embed_store = EmbeddingStore(self.encoder_tag)
+        else:
+            self.embed_store = None
 
-    def _init_model(self):
+    def _resolve_backend(self, backend: str) -> str:
+
+        if self.model == "bm25":
+            return "torch"
+        backend = resolve_backend(backend, self.device)
+        if backend != "torch" and self.device != "cpu":
+            print(f"{backend} backend runs on CPU, ignoring device {self.device}!")
+            self.device = "cpu"
+        return backend
+
+    def _load_encoder(self, device: str):
 
         if self.model == "contriever":
-            self.retr_model = SentenceTransformer("nishimoto/contriever-sentencetransformer", device=self.device)
+            return SentenceTransformer("nishimoto/contriever-sentencetransformer", device=device)
         elif self.model == "dpr":
-            self.retr_model = SentenceTransformer("sentence-transformers/facebook-dpr-ctx_encoder-single-nq-base", device=self.device)  
+            return SentenceTransformer("sentence-transformers/facebook-dpr-ctx_encoder-single-nq-base", device=device)  
         else:
-            self.retr_model = SentenceTransformer(self.model, device=self.device)
+            return SentenceTransformer(self.model, device=device)
 
-    def check_file(self):
+    def _init_model(self):
 
-        file_path = os.path.join(self.save_loc, f"{self.dataset.tag}_{self.model}.json")
-        if os.path.exists(file_path):
-            with open(file_path, "r") as f:
-                all_idxs = json.load(f)
-        else:
+        if self.model == "bm25":
+            self.retr_model = None
+            return
+        self.retr_model = self._load_encoder(self.device)
+        if self.backend == "int8":
+            self.retr_model = quantize_int8(self.retr_model)
+        elif self.backend == "onnx":
+            self.retr_model = OnnxEncoder(self.retr_model, os.path.join("files", "onnx", f"{self.model.replace('/', '_')}.onnx"))
+
+    def start_pool(self):
+
+        if self.pool is not None or not self.num_workers or self.retr_model is None:
+            return self.pool
+        if self.backend != "torch":
+            print(f"Encoder pool is not supported for the {self.backend} backend, encoding in a single process!")
+            self.num_workers = None
+            return None
+
+        threads_per_worker = str(max(1, (os.cpu_count() or 1) // self.num_workers))
+        prev_threads = os.environ.get("OMP_NUM_THREADS")
+        os.environ["OMP_NUM_THREADS"] = threads_per_worker
+        try:
+            target_devices = [self.device] * self.num_workers if self.device == "cpu" else None
+            self.pool = self.retr_model.start_multi_process_pool(target_devices=target_devices)
+        finally:
+            if prev_threads is None:
+                os.environ.pop("OMP_NUM_THREADS")
+            else:
+                os.environ["OMP_NUM_THREADS"] = prev_threads
+        atexit.register(self.close)
+        print(f"Started encoder pool with {len(self.pool['processes'])} workers!")
+        return self.pool
+
+    def close(self):
+
+        if self.pool is not None:
+            SentenceTransformer.stop_multi_process_pool(self.pool)
+            self.pool = None
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        self.close()
+
+    def get_cache(self, k: int) -> RetrievalCache:
+
+        path_prefix = os.path.join(self.save_loc, f"{self.dataset.cache_tag}_{self.retrieval_tag}")
+        is_new = not os.path.exists(f"{path_prefix}.meta.json")
+        cache = RetrievalCache(path_prefix, max(k, self.k_max))
+        if is_new and os.path.exists(f"{path_prefix}.json"):
+            cache.import_json(f"{path_prefix}.json")
+        elif len(cache) == 0:
             print("Retrieval results are not cached, starting from 0!")
-            all_idxs = []
-        return all_idxs
-    
-    def save_file(self, obj):
+        return cache
+
+    def get_retrieval_results(self, queries: List[str], retr_texts: List[List[str]], k: int = None, largest: bool = True):
+
+        if self.model == "bm25":
+            return self._bm25_retrieval(queries, retr_texts, k, largest)
+        return self._neural_retrieval(queries, retr_texts, k, largest)
+
+    def _init_bm25_index(self, retr_texts: List[List[str]]):
+
+        index_dir = os.path.join("files", "bm25", self.dataset.cache_tag)
+        if self.bm25_index is None and os.path.exists(os.path.join(index_dir, "weights.npz")):
+            self.bm25_index = BM25Index.load(index_dir)
+        if self.bm25_index is None or self.bm25_index.num_users != len(retr_texts) or self.bm25_index.offsets[-1] != sum(len(docs) for docs in retr_texts):
+            print("Building BM25 index for the dataset!")
+            self.bm25_index = BM25Index().build(retr_texts)
+            self.bm25_index.save(index_dir)
+        return self.bm25_index
 
-        file_path = os.path.join(self.save_loc, f"{self.dataset.tag}_{self.model}.json")
-        with open(file_path, "w") as f:
-            json.dump(obj, f)
+    def _bm25_retrieval(self, queries: List[str], docs: List[str], k: int = None, largest: bool = True):
 
-    def get_retrieval_results(self, queries: List[str], retr_texts: List[List[str]]) -> List[List[int]]:
+        index = BM25Index().build([docs])
+        query_matrix = index.query_matrix([queries] if isinstance(queries, str) else queries)
+        sorted_idxs, similarities = self.engine.topk(query_matrix, index.weights, k, largest)
+        if isinstance(queries, str):
+            sorted_idxs, similarities = sorted_idxs[0], similarities[0]
 
-        return self._neural_retrieval(queries, retr_texts)
+        return similarities.tolist(), sorted_idxs.tolist()
 
     def _encode(self, docs):
 
-        if not isinstance(docs, np.ndarray):
-            return self.retr_model.encode(docs)
-        else:
+        if self.retr_model is None:
+            raise ValueError(f"{self.model} retriever has no dense encoder!")
+        if isinstance(docs, np.ndarray):
             return docs
+        if isinstance(docs, str):
+            return self._encode([docs])[0]
+
+        unique_docs = list(dict.fromkeys(docs))
+        if len(unique_docs) < len(docs):
+            positions = {doc: i for i, doc in enumerate(unique_docs)}
+            return self._encode(unique_docs)[[positions[doc] for doc in docs]]
+
+        if self.embed_store is None:
+            return self._encode_repeated(docs)
+
+        embeds, found = self.embed_store.lookup(docs)
+        if found.all():
+            return embeds
+        missing = np.flatnonzero(~found)
+        missing_embeds = self._encode_bucketed([docs[i] for i in missing])
+        self.embed_store.add([docs[i] for i in missing], missing_embeds)
+        if embeds is None:
+            return missing_embeds
+        embeds[missing] = missing_embeds
+        return embeds
+
+    def _encode_repeated(self, docs: List[str]) -> np.ndarray:
+
+        if not self.repeated_docs:
+            return self._encode_bucketed(docs)
+        new_docs = [doc for doc in docs if doc not in self.repeated_embeds]
+        new_embeds = self._encode_bucketed(new_docs)
+        for doc, embed in zip(new_docs, new_embeds):
+            if doc in self.repeated_docs:
+                self.repeated_embeds[doc] = embed
+        positions = {doc: i for i, doc in enumerate(new_docs)}
+        return np.stack([new_embeds[positions[doc]] if doc in positions else self.repeated_embeds[doc] for doc in docs])
+
+    def _encode_bucketed(self, docs: List[str], model=None) -> np.ndarray:
+
+        pool = self.start_pool() if model is None else None
+        model = self.retr_model if model is None else model
+        if len(docs) == 0:
+            return np.zeros((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+        order = np.argsort([len(doc) for doc in docs], kind="stable")
+        embeds = None
+        for start in range(0, len(order), self.bucket_size):
+            bucket = order[start:start+self.bucket_size]
+            if pool is not None:
+                bucket_embeds = model.encode_multi_process([docs[i] for i in bucket], pool, batch_size=self.batch_size)
+            else:
+                bucket_embeds = model.encode([docs[i] for i in bucket], batch_size=self.batch_size, convert_to_numpy=True)
+            if embeds is None:
+                embeds = np.empty((len(docs), bucket_embeds.shape[1]), dtype=bucket_embeds.dtype)
+            embeds[bucket] = bucket_embeds
+        return embeds
+
+    def _prepare_embeds(self, embeds: np.ndarray) -> np.ndarray:
+
+        if getattr(self.retr_model, "similarity_fn_name", "cosine") == "cosine":
+            norms = np.linalg.norm(embeds, axis=-1, keepdims=True)
+            return embeds / np.clip(norms, 1e-12, None)
+        return embeds
+
+    @staticmethod
+    def _top_k(similarities: np.ndarray, k: int = None) -> np.ndarray:
+
+        if k is None or k >= len(similarities):
+            return np.argsort(-similarities, kind="stable")
+        top_idxs = np.argpartition(-similarities, k-1)[:k]
+        return top_idxs[np.argsort(-similarities[top_idxs], kind="stable")]
+
+    def batch_retrieval(self, queries: List[str], retr_texts: List[List[str]], k: int = None, users: np.ndarray = None, min_candidates: int = None):
+
+        users = np.arange(len(queries)) if users is None else users
+        min_candidates = k if min_candidates is None else min_candidates
+        candidates = self._rating_candidates(retr_texts, users, min_candidates) if self.rating_window is not None else None
+        if self.model == "bm25":
+            flat_sims = self.bm25_index.user_scores(queries, users)
+            return self._candidate_top_k(flat_sims, [len(docs) for docs in retr_texts], k, candidates)
+        elif self.cascade_m:
+            return self._dense_retrieval(queries, retr_texts, k, self._cascade_candidates(queries, retr_texts, users, candidates))
+        else:
+            return self._dense_retrieval(queries, retr_texts, k, candidates)
+
+    def _rating_candidates(self, retr_texts: List[List[str]], users: np.ndarray, min_candidates: int = None) -> List[np.ndarray]:
+
+        query_ratings, _ = self.dataset.get_rating_arrays()
+        all_buckets = self.dataset.get_rating_buckets()
+        candidates = []
+        for user, docs in zip(users, retr_texts):
+            buckets = [idxs for rating, idxs in all_buckets[user].items() if abs(rating - query_ratings[user]) <= self.rating_window]
+            cands = np.sort(np.concatenate(buckets + [np.zeros(0, dtype=np.int64)])).astype(np.int64)
+            min_docs = len(docs) if min_candidates is None else min(min_candidates, len(docs))
+            candidates.append(cands if len(cands) >= min_docs else np.arange(len(docs), dtype=np.int64))
+        return candidates
+
+    def _candidate_top_k(self, flat_sims: np.ndarray, doc_counts: List[int], k: int = None, candidates: List[np.ndarray] = None):
+
+        if candidates is None:
+            return self._segmented_top_k(flat_sims, doc_counts, k)
+        offsets = np.concatenate([[0], np.cumsum(doc_counts)])[:-1].astype(np.int64)
+        flat_cands = np.concatenate([offsets[i] + cands for i, cands in enumerate(candidates)] + [np.zeros(0, dtype=np.int64)])
+        all_sims, all_idxs = self._segmented_top_k(flat_sims[flat_cands], [len(cands) for cands in candidates], k)
+        return all_sims, [np.asarray(candidates[i])[idxs].tolist() for i, idxs in enumerate(all_idxs)]
+
+    def _dense_retrieval(self, queries: List[str], retr_texts: List[List[str]], k: int = None, candidates: List[np.ndarray] = None):
+
+        if candidates is None:
+            docs = [doc for doc_list in retr_texts for doc in doc_list]
+            doc_counts = [len(doc_list) for doc_list in retr_texts]
+        else:
+            docs = [retr_texts[i][j] for i, cands in enumerate(candidates) for j in cands]
+            doc_counts = [len(cands) for cands in candidates]
 
-    def _neural_retrieval(self, queries: List[str], docs: List[str]):
-
-        query_embeds = self._encode(queries)
-        doc_embeds = self._encode(docs)
-        similarities = self.retr_model.similarity(query_embeds, doc_embeds).numpy().squeeze().tolist()
-        sorted_idxs = np.argsort(similarities)[::-1].tolist()
-        if isinstance(similarities, float):
-            similarities = [similarities]
+        query_embeds = self._prepare_embeds(self._encode(queries))
+        if self.compression == "pq":
+            doc_owners = np.repeat(np.arange(len(query_embeds)), doc_counts)
+            flat_sims = self._get_pq().adc_scores(query_embeds, self._encode_codes(docs), doc_owners)
+        else:
+            flat_sims = self._doc_similarities(query_embeds, self._prepare_embeds(self._encode(docs)), doc_counts)
+        all_sims, all_idxs = self._segmented_top_k(flat_sims, doc_counts, k)
+        if candidates is not None:
+            all_idxs = [np.asarray(candidates[i])[idxs].tolist() for i, idxs in enumerate(all_idxs)]
+        return all_sims, all_idxs
+
+    def _cascade_candidates(self, queries: List[str], retr_texts: List[List[str]], users: np.ndarray, candidates: List[np.ndarray] = None) -> List[np.ndarray]:
+
+        lexical_sims = self.bm25_index.user_scores(queries, users)
+        _, candidates = self._candidate_top_k(lexical_sims, [len(docs) for docs in retr_texts], self.cascade_m, candidates)
+        return [np.asarray(cands, dtype=np.int64) for cands in candidates]
+
+    def cascade_agreement(self, queries: List[str], retr_texts: List[List[str]], k: int = 10, sample_size: int = 200, seed: int = 0):
+
+        self._init_bm25_index(retr_texts)
+        if self.compression == "pq":
+            self._get_pq(retr_texts)
+        sample = np.random.default_rng(seed).choice(len(queries), min(sample_size, len(queries)), replace=False)
+        sample_queries = [queries[i] for i in sample]
+        sample_texts = [retr_texts[i] for i in sample]
+
+        candidates = self._cascade_candidates(sample_queries, sample_texts, sample)
+        _, exact_idxs = self._dense_retrieval(sample_queries, sample_texts, k)
+        _, cascade_idxs = self._dense_retrieval(sample_queries, sample_texts, k, candidates)
+
+        exact_match = np.mean([set(a) == set(b) for a, b in zip(cascade_idxs, exact_idxs)])
+        overlap = np.mean([len(set(a) & set(b)) / max(1, len(b)) for a, b in zip(cascade_idxs, exact_idxs)])
+        encoded_ratio = sum(len(cands) for cands in candidates) / max(1, sum(len(docs) for docs in sample_texts))
+        print(f"Cascade (M={self.cascade_m}) top-{k} over {len(sample)} users: exact match {exact_match:.4f}, overlap {overlap:.4f}, documents encoded {encoded_ratio:.2%}")
+        return exact_match, overlap
+
+    @staticmethod
+    def _flat_similarities(query_embeds: np.ndarray, doc_embeds: np.ndarray, doc_counts: List[int]) -> np.ndarray:
+
+        doc_owners = np.repeat(np.arange(len(query_embeds)), doc_counts)
+        return np.einsum("ij,ij->i", doc_embeds, query_embeds[doc_owners])
+
+    def _get_pq(self, retr_texts: List[List[str]] = None, seed: int = 0) -> ProductQuantizer:
+
+        if self.pq is not None:
+            return self.pq
+        pq_tag = f"{self.encoder_tag}-PQ{self.pq_subspaces}-{self.dataset.cache_tag}"
+        pq_path = os.path.join("files", "embeddings", f"{pq_tag.replace('/', '_')}.npz")
+        if os.path.exists(pq_path):
+            self.pq = ProductQuantizer.load(pq_path)
+        else:
+            if retr_texts is None:
+                raise ValueError(f"Product quantizer for {self.dataset.cache_tag} is not trained yet!")
+            docs = [doc for doc_list in retr_texts for doc in doc_list]
+            sample = np.sort(np.random.default_rng(seed).choice(len(docs), min(self.pq_train_size, len(docs)), replace=False))
+            print(f"Training product quantizer on {len(sample)} sampled profile documents!")
+            self.pq = ProductQuantizer(n_subspaces=self.pq_subspaces, seed=seed).fit(self._prepare_embeds(self._encode_bucketed([docs[i] for i in sample])))
+            self.pq.save(pq_path)
+        if self.embed_store is not None:
+            self.code_store = EmbeddingStore(pq_tag, dtype="uint8")
+        return self.pq
+
+    def _encode_codes(self, docs: List[str]) -> np.ndarray:
+
+        pq = self._get_pq()
+        unique_docs = list(dict.fromkeys(docs))
+        if len(unique_docs) < len(docs):
+            positions = {doc: i for i, doc in enumerate(unique_docs)}
+            return self._encode_codes(unique_docs)[[positions[doc] for doc in docs]]
+        if self.code_store is None:
+            return pq.encode(self._prepare_embeds(self._encode_bucketed(docs)))
+
+        codes, found = self.code_store.lookup(docs)
+        if found.all():
+            return codes
+        missing = np.flatnonzero(~found)
+        missing_codes = pq.encode(self._prepare_embeds(self._encode_bucketed([docs[i] for i in missing])))
+        self.code_store.add([docs[i] for i in missing], missing_codes)
+        if codes is None:
+            return missing_codes
+        codes[missing] = missing_codes
+        return codes
+
+    def _doc_similarities(self, query_embeds: np.ndarray, doc_embeds: np.ndarray, doc_counts: List[int]) -> np.ndarray:
+
+        if self.compression == "fp16":
+            doc_embeds = doc_embeds.astype(np.float16, copy=False)
+        elif self.compression == "pq":
+            pq = self._get_pq()
+            doc_owners = np.repeat(np.arange(len(query_embeds)), doc_counts)
+            return pq.adc_scores(query_embeds, pq.encode(doc_embeds), doc_owners)
+        return self._flat_similarities(query_embeds, doc_embeds, doc_counts)
+
+    def compression_agreement(self, queries: List[str], retr_texts: List[List[str]], k: int = 10, sample_size: int = 200, seed: int = 0):
+
+        if self.compression == "pq":
+            self._get_pq(retr_texts, seed)
+        sample = np.random.default_rng(seed).choice(len(queries), min(sample_size, len(queries)), replace=False)
+        doc_counts = [len(retr_texts[i]) for i in sample]
+        query_embeds = self._prepare_embeds(self._encode_bucketed([queries[i] for i in sample]))
+        doc_embeds = self._prepare_embeds(self._encode_bucketed([doc for i in sample for doc in retr_texts[i]]))
+
+        _, exact_idxs = self._segmented_top_k(self._flat_similarities(query_embeds, doc_embeds, doc_counts), doc_counts, k)
+        _, approx_idxs = self._segmented_top_k(self._doc_similarities(query_embeds, doc_embeds, doc_counts), doc_counts, k)
+
+        overlap = np.mean([len(set(a) & set(b)) / max(1, len(b)) for a, b in zip(approx_idxs, exact_idxs)])
+        print(f"Top-{k} overlap of {self.compression} embeddings with fp32 over {len(sample)} users: {overlap:.4f}")
+        num_docs, dim = sum(len(docs) for docs in retr_texts), doc_embeds.shape[1]
+        size = compressed_nbytes(num_docs, dim, self.compression, self.pq_subspaces) / 2**20
+        print(f"Storing {num_docs} {self.compression} document embeddings takes {size:.2f} MB (fp32: {compressed_nbytes(num_docs, dim) / 2**20:.2f} MB)")
+        return overlap
+
+    def _segmented_top_k(self, flat_sims: np.ndarray, doc_counts: List[int], k: int = None):
+
+        offsets = np.concatenate([[0], np.cumsum(doc_counts)]).astype(np.int64)
+
+        all_sims, all_idxs = [], []
+        for i in range(len(doc_counts)):
+            sims = flat_sims[offsets[i]:offsets[i+1]]
+            top_idxs = self._top_k(sims, k)
+            all_sims.append(sims[top_idxs].tolist())
+            all_idxs.append(top_idxs.tolist())
+        return all_sims, all_idxs
+
+    def backend_parity(self, queries: List[str], retr_texts: List[List[str]], k: int = 10, sample_size: int = 200, seed: int = 0) -> float:
+
+        sample = np.random.default_rng(seed).choice(len(queries), min(sample_size, len(queries)), replace=False)
+        sample_queries = [queries[i] for i in sample]
+        sample_docs = [doc for i in sample for doc in retr_texts[i]]
+        doc_counts = [len(retr_texts[i]) for i in sample]
+
+        ref_model = self._load_encoder(get_device())
+        ref_sims = self._flat_similarities(self._prepare_embeds(self._encode_bucketed(sample_queries, ref_model)),
+                                           self._prepare_embeds(self._encode_bucketed(sample_docs, ref_model)), doc_counts)
+        del ref_model
+        sims = self._flat_similarities(self._prepare_embeds(self._encode_bucketed(sample_queries)),
+                                       self._prepare_embeds(self._encode_bucketed(sample_docs)), doc_counts)
+        _, ref_idxs = self._segmented_top_k(ref_sims, doc_counts, k)
+        _, idxs = self._segmented_top_k(sims, doc_counts, k)
+
+        overlap = np.mean([len(set(a) & set(b)) / max(1, len(b)) for a, b in zip(idxs, ref_idxs)])
+        print(f"Top-{k} overlap of {self.backend} backend with fp32 model over {len(sample)} users: {overlap:.4f}")
+        return overlap
+
+    def _neural_retrieval(self, queries: List[str], docs: List[str], k: int = None, largest: bool = True):
+
+        query_embeds = self._prepare_embeds(self._encode(queries))
+        doc_embeds = self._prepare_embeds(self._encode(docs))
+        sorted_idxs, similarities = self.engine.topk(query_embeds, doc_embeds, k, largest)
             
-        return similarities, sorted_idxs
+        return similarities.tolist(), sorted_idxs.tolist()
 
     def semantic_consensus_weighting(self, outputs):
 
-        embeds = self._encode(outputs)
-        similarity_matrix = self.retr_model.similarity(embeds, embeds)   
-        aggregated_scores = similarity_matrix.sum(axis=1)
+        embeds = self._prepare_embeds(self._encode(outputs))
+        aggregated_scores = self.engine.row_sums(embeds, embeds)
         best_response_index = np.argmax(aggregated_scores)
         
         return outputs[best_response_index]
 
+    def batch_semantic_consensus(self, all_outputs: List[List[str]]) -> List[str]:
+
+        counts = np.array([len(outputs) for outputs in all_outputs], dtype=np.int64)
+        flat_outputs = [output for outputs in all_outputs for output in outputs]
+        if len(flat_outputs) == 0:
+            return [None] * len(all_outputs)
+
+        embeds = self._prepare_embeds(self._encode(flat_outputs))
+        owners = np.repeat(np.arange(len(all_outputs)), counts)
+        group_sums = np.zeros((len(all_outputs), embeds.shape[1]), dtype=embeds.dtype)
+        np.add.at(group_sums, owners, embeds)
+        scores = np.einsum("ij,ij->i", embeds, group_sums[owners])
+
+        order = np.lexsort((-scores, owners))
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        winners = order[np.minimum(starts, len(order) - 1)]
+        return [flat_outputs[winner] if count > 0 else None for winner, count in zip(winners, counts)]
+
+    def _build_query_index(self, query_embeds: np.ndarray) -> IVFIndex:
+
+        if self.query_index is None or not np.array_equal(self.query_index.embeds, query_embeds):
+            self.query_index = IVFIndex(n_probe=self.n_probe).build(query_embeds)
+        return self.query_index
+
+    def get_user_centroids(self, retr_texts: List[List[str]]) -> np.ndarray:
+
+        centroid_path = os.path.join(self.save_loc, f"{self.dataset.cache_tag}_{self.encoder_tag}_centroids.npy")
+        if os.path.exists(centroid_path):
+            centroids = np.load(centroid_path)
+            if len(centroids) == len(retr_texts):
+                return centroids
+
+        print("Computing user profile centroids!")
+        centroids = []
+        for start in range(0, len(retr_texts), self.save_every):
+            batch_texts = retr_texts[start:start+self.save_every]
+            doc_counts = np.array([len(docs) for docs in batch_texts], dtype=np.int64)
+            doc_embeds = self._prepare_embeds(self._encode([doc for docs in batch_texts for doc in docs]))
+            sums = np.zeros((len(batch_texts), doc_embeds.shape[1]), dtype=np.float32)
+            np.add.at(sums, np.repeat(np.arange(len(batch_texts)), doc_counts), doc_embeds)
+            centroids.append(sums / np.maximum(doc_counts, 1)[:, None])
+        centroids = self._prepare_embeds(np.concatenate(centroids)).astype(np.float32)
+        np.save(centroid_path, centroids)
+        return centroids
+
+    def get_user_clusters(self, queries: List[str], retr_texts: List[List[str]] = None):
+
+        n_clusters = self.n_clusters or max(2, int(np.sqrt(len(queries))))
+        cluster_path = os.path.join(self.save_loc, f"{self.dataset.cache_tag}_{self.encoder_tag}_clusters_{self.cluster_on}_{n_clusters}.npz")
+        if os.path.exists(cluster_path):
+            clusters = np.load(cluster_path)
+            if len(clusters["assignments"]) == len(queries):
+                return clusters["centroids"], clusters["assignments"]
+
+        print(f"Clustering users into {n_clusters} clusters!")
+        if self.cluster_on == "profile":
+            user_embeds = self.get_user_centroids(retr_texts)
+        else:
+            user_embeds = self._prepare_embeds(self._encode(queries)).astype(np.float32)
+        centroids, assignments = kmeans(user_embeds, n_clusters)
+        np.savez(cluster_path, centroids=centroids, assignments=assignments)
+        return centroids, assignments
+
+    def _cluster_contrastive_users(self, queries: List[str], num_ce: int, retr_texts: List[List[str]] = None, seed: int = 0) -> List[List[int]]:
+
+        centroids, assignments = self.get_user_clusters(queries, retr_texts)
+        centroids = self._prepare_embeds(centroids)
+        farthest_clusters = np.argsort(centroids @ centroids.T, axis=1, kind="stable")
+        order = np.argsort(assignments, kind="stable")
+        bounds = np.searchsorted(assignments[order], np.arange(len(centroids) + 1))
+        members = [order[bounds[c]:bounds[c+1]] for c in range(len(centroids))]
+
+        rng = np.random.default_rng(seed)
+        all_ce_idxs = []
+        for i in range(len(queries)):
+            ce_idxs = []
+            for c in farthest_clusters[assignments[i]]:
+                if len(ce_idxs) >= num_ce:
+                    break
+                candidates = members[c][members[c] != i]
+                ce_idxs.extend(rng.choice(candidates, min(num_ce - len(ce_idxs), len(candidates)), replace=False).tolist())
+            all_ce_idxs.append(ce_idxs[::-1])
+        return all_ce_idxs
+
+    def get_contrastive_users(self, queries: List[str], num_ce: int, retr_texts: List[List[str]] = None) -> List[List[int]]:
+
+        if self.ce_mode == "exact":
+            _, ce_retr_res = self.get_retrieval_results(queries, queries, k=num_ce, largest=False)
+            return [ce_retr[::-1] for ce_retr in ce_retr_res]
+        elif self.ce_mode == "ivf":
+            query_embeds = self._prepare_embeds(self._encode(queries))
+            ce_idxs, _ = self._build_query_index(query_embeds).search(query_embeds, num_ce, farthest=True)
+            return [idxs[idxs >= 0][::-1].tolist() for idxs in ce_idxs]
+        elif self.ce_mode == "centroid":
+            query_embeds = self._prepare_embeds(self._encode(queries))
+            ce_idxs, _ = self.engine.topk(query_embeds, self.get_user_centroids(retr_texts), num_ce, largest=False)
+            return [idxs[::-1].tolist() for idxs in ce_idxs]
+        elif self.ce_mode == "cluster":
+            return self._cluster_contrastive_users(queries, num_ce, retr_texts)
+        else:
+            raise ValueError(f"Unknown contrastive mode: {self.ce_mode}")
+
+    def contrastive_recall(self, queries: List[str], num_ce: int, sample_size: int = 1000, seed: int = 0) -> float:
+
+        query_embeds = self._prepare_embeds(self._encode(queries))
+        sample = np.random.default_rng(seed).choice(len(queries), min(sample_size, len(queries)), replace=False)
+        exact_idxs, _ = self.engine.topk(query_embeds[sample], query_embeds, num_ce, largest=False)
+        approx_idxs, _ = self._build_query_index(query_embeds).search(query_embeds[sample], num_ce, farthest=True)
+        recall = recall_at_k(approx_idxs, exact_idxs)
+        print(f"Contrastive recall@{num_ce} of {self.ce_mode} search over {len(sample)} queries: {recall:.4f}")
+        return recall
+
     def contrastive_retrieval(self, queries, retr_texts, retr_gts, num_ce, ce_k):
 
         _, retr_gt_name, retr_prompt_name = self.dataset.get_var_names()
-        _, ce_retr_res = self.get_retrieval_results(queries, queries)
 
         all_ce_examples = []
-        for ce_retr in ce_retr_res:
+        if isinstance(retr_gt_name, tuple):
+            _, all_doc_ratings = self.dataset.get_rating_arrays()
+
+        for ce_idxs in self.get_contrastive_users(queries, num_ce, retr_texts):
 
-            ce_idxs = ce_retr[-num_ce:]
             ce_examples = []
             for ce in ce_idxs:
                 ce_example = []
                 max_range = len(retr_texts[ce]) if ce_k > len(retr_texts[ce]) else ce_k
                 if isinstance(retr_gt_name, tuple):
-                    _, doc_ratings = self.dataset.get_ratings(ce)
+                    doc_ratings = all_doc_ratings[ce]
                 for j in range(max_range):
                     if retr_gt_name:
                         if isinstance(retr_gt_name, tuple):
@@ -103,35 +590,63 @@ class Retriever:
             
         return all_ce_examples
 
-    def get_context(self, queries: List[str], retr_texts: List[List[str]], retr_gts: List[List[str]], k: str) -> List[List[str]]:
+    @staticmethod
+    def _adaptive_k(scores: np.ndarray, k: int, threshold: float, relative: bool = False, min_k: int = 1) -> int:
+
+        scores = np.asarray(scores[:k], dtype=np.float32)
+        if len(scores) == 0 or np.isnan(scores).any():
+            return k
+        cutoff = scores[0] - (1 - threshold) * abs(scores[0]) if relative else threshold
+        return int(np.clip(np.sum(scores >= cutoff), min(min_k, k), k))
+
+    def get_context(self, queries: List[str], retr_texts: List[List[str]], retr_gts: List[List[str]], k: str, threshold: float = None, relative: bool = False, min_k: int = 1) -> List[List[str]]:
 
+        self.chosen_ks = [0] * len(queries) if k == 0 else []
         if k == 0:
             return [""] * len(queries)
+        if self.cascade_m and self.cascade_m < k:
+            raise ValueError(f"Cascade candidate count {self.cascade_m} is smaller than k={k}!")
+
+        cache = self.get_cache(k)
+        row_lengths = cache.row_lengths()
+        if any(row_len < min(k, len(retr_texts[i])) for i, row_len in enumerate(row_lengths)):
+            print("Cached retrieval results are shorter than k, starting from 0!")
+            cache.reset()
+
+        if (self.model == "bm25" or self.cascade_m) and len(cache) < len(queries):
+            self._init_bm25_index(retr_texts)
+        if self.compression == "pq" and len(cache) < len(queries):
+            self._get_pq(retr_texts)
+        if self.embed_store is None and self.retr_model is not None and len(cache) < len(queries):
+            user_counts = Counter(doc for docs in retr_texts[len(cache):] for doc in set(docs))
+            self.repeated_docs = {doc for doc, count in user_counts.items() if count > 1}
+
+        for start in range(len(cache), len(queries), self.save_every):
+            end = min(start + self.save_every, len(queries))
+            batch_sims, batch_idxs = self.batch_retrieval(queries[start:end], retr_texts[start:end], cache.k_max, np.arange(start, end), k)
+            cache.append(batch_idxs, batch_sims)
+            print(end)
+        self.repeated_docs = None
+        self.repeated_embeds = {}
 
-        all_idxs = self.check_file()
         all_examples = []
         _, retr_gt_name, retr_prompt_name = self.dataset.get_var_names()
+        if isinstance(retr_gt_name, tuple):
+            _, all_doc_ratings = self.dataset.get_rating_arrays()
 
         for i, query in enumerate(queries):
             
             retr_text = retr_texts[i]
             retr_gt = retr_gts[i]
-            if len(all_idxs) > i:
-                sorted_idxs = all_idxs[i]
-            else:
-                _, sorted_idxs = self.get_retrieval_results(query, retr_text)
-                
-                all_idxs.append(sorted_idxs)
-                if ((i+1)%500 == 0) or (i+1 == len(queries)):
-                    print(i)     
-                    self.save_file(all_idxs)
+            sorted_idxs, scores = cache.get(i)
+            num_docs = k if threshold is None else self._adaptive_k(scores, k, threshold, relative, min_k)
+            self.chosen_ks.append(min(num_docs, len(sorted_idxs)))
 
-            texts = [retr_text[doc_id] for doc_id in sorted_idxs[:k]]                
-            gts = [retr_gt[doc_id] for doc_id in sorted_idxs[:k]]
+            texts = [retr_text[doc_id] for doc_id in sorted_idxs[:num_docs]]                
+            gts = [retr_gt[doc_id] for doc_id in sorted_idxs[:num_docs]]
 
             if isinstance(retr_gt_name, tuple):
-                _, doc_ratings = self.dataset.get_ratings(i)
-                doc_ratings = [doc_ratings[doc_id] for doc_id in sorted_idxs[:k]]
+                doc_ratings = all_doc_ratings[i][sorted_idxs[:num_docs]]
                 
             examples = []
 
@@ -148,6 +663,21 @@ class Retriever:
 
         return all_examples
 
+    def get_context_sweep(self, queries: List[str], retr_texts: List[List[str]], retr_gts: List[List[str]], ks: List[int]) -> dict:
+
+        all_examples = self.get_context(queries, retr_texts, retr_gts, max(ks))
+        max_chosen_ks = self.chosen_ks
+        all_contexts = {}
+        self.sweep_ks = {}
+        for k in ks:
+            if k == 0:
+                all_contexts[k] = [""] * len(queries)
+                self.sweep_ks[k] = [0] * len(queries)
+            else:
+                all_contexts[k] = [examples[:k] for examples in all_examples]
+                self.sweep_ks[k] = [min(k, chosen_k) for chosen_k in max_chosen_ks]
+        return all_contexts
+
     def calculate_one_to_one_distances(self, texts1: List[str], texts2: List[str]) -> List[float]:
         """Calculate semantic distances between corresponding pairs of texts.
         
@@ -3,19 +3,25 @@ import time
 import json
 import sys
 import copy
+import random
 
 import torch 
 
 from models import LLM
-from prompts import prepare_res_prompt
+from prompts import prepare_res_prompt, get_prompt_prefix
 from feature_processor import FeatureProcessor
 from retriever import Retriever
 
 from utils.argument_parser import parse_args
-from utils.file_utils import oai_get_or_create_file
+from utils.file_utils import oai_get_or_create_file, get_exp_name
 from utils.misc import get_model_list
+from utils.dedup import dedup_profiles, dedup_savings
 
 args, dataset, final_feature_list, k = parse_args()
+if args.k_sweep:
+    k = max(args.k_sweep)
+if args.prefix_cache and args.batch_size > 1 and not (args.continuous_batching or args.k_sweep):
+    raise ValueError("Prefix cache is not used by padded batch generation, use -cb or -bs 1!")
 MAX_NEW_TOKENS = 64 if dataset.name == "lamp" else 128
 MAX_NEW_TOKENS = MAX_NEW_TOKENS if args.prompt_style == "regular" else MAX_NEW_TOKENS * 10
 pred_path = os.path.join("files", "preds")
@@ -23,35 +29,165 @@ os.makedirs(pred_path, exist_ok=True)
 
 if dataset.name == "lamp":
     ids = dataset.get_ids()    
+elif dataset.name == "amazon":
+    query_ratings, _ = dataset.get_rating_arrays()
 
 LLMs = get_model_list()
 # LLMs = ["GPT-4o"]
 
 queries, retr_texts, retr_gts = dataset.get_retr_data() 
-retriever = Retriever(dataset, args.retriever)
-all_context = retriever.get_context(queries, retr_texts, retr_gts, k) 
+if args.dedup is not None:
+    kept_idxs = dedup_profiles(dataset.tag, retr_texts, retr_gts, args.dedup)
+    savings = dedup_savings(retr_texts, retr_gts, kept_idxs)
+    print(f"Removed {savings['removed_docs']} of {savings['total_docs']} profile documents as near-duplicates, saving {savings['removed_words']} of {savings['total_words']} words ({100*savings['removed_words']/max(savings['total_words'], 1):.2f}%) of prompt context!")
+    dataset.filter_profiles(kept_idxs, f"DD{args.dedup}")
+    queries, retr_texts, retr_gts = dataset.get_retr_data()
+retriever = Retriever(dataset, args.retriever, backend=args.retr_backend, ce_mode=args.ce_mode, cascade_m=args.cascade_m, num_workers=args.num_workers, compression=args.embed_compression, rating_window=args.rating_window)
+if retriever.backend != "torch":
+    retriever.backend_parity(queries, retr_texts)
+if retriever.cascade_m and k:
+    retriever.cascade_agreement(queries, retr_texts, k)
+if retriever.compression and k:
+    retriever.compression_agreement(queries, retr_texts, k)
+if args.k_sweep:
+    if args.adaptive_threshold is not None:
+        raise ValueError("Adaptive k can not be combined with a k-sweep!")
+    sweep_context = retriever.get_context_sweep(queries, retr_texts, retr_gts, args.k_sweep)
+    all_context = sweep_context[k]
+else:
+    all_context = retriever.get_context(queries, retr_texts, retr_gts, k, threshold=args.adaptive_threshold, relative=args.adaptive_relative, min_k=args.min_k)
+if args.adaptive_threshold is not None and k:
+    print(f"Adaptive k: mean {sum(retriever.chosen_ks)/len(retriever.chosen_ks):.2f}, max {k}")
 
 if args.features:
     feature_processor = FeatureProcessor()
-    all_features = feature_processor.get_all_features(dataset.tag, args.features, retr_texts, retr_gts)
+    all_features = feature_processor.get_all_features(dataset.cache_tag, args.features, retr_texts, retr_gts)
     prepared_features = feature_processor.prepare_features(all_features, args.features)
 else:
     features = None
 
 if args.counter_examples:
     ce_k = 3 if k == 50 else 1
+    if args.ce_mode == "ivf":
+        retriever.contrastive_recall(queries, args.counter_examples)
     all_ce_examples = retriever.contrastive_retrieval(queries, retr_texts, retr_gts, args.counter_examples, ce_k)
+retriever.close()
 
-print(f"Running experiments for {dataset.tag} with Features: {final_feature_list}, Retriever: {args.retriever}, Repetition Step: {args.repetition_step}, Prompt Style: {args.prompt_style} and K: {k}")
+print(f"Running experiments for {dataset.tag} with Features: {final_feature_list}, Retriever: {args.retriever}, Repetition Step: {args.repetition_step}, Prompt Style: {args.prompt_style} and K: {args.k_sweep if args.k_sweep else k}")
 sys.stdout.flush()
 
-for model_name in LLMs:
 
-    exp_name = f"{dataset.tag}_{model_name}_{final_feature_list}_{args.retriever}_RS({args.repetition_step})_K({k})"
+def load_llm(model_name):
+
+    model_params = None
+    if model_name.endswith("70B"):
+        print("70B model, using quantization!")
+        model_params = {
+            "quantization": {
+                "load_in_4bit": True,
+                "bnb_4bit_compute_dtype": torch.float16,
+                "bnb_4bit_quant_type": "nf4",
+                "bnb_4bit_use_double_quant": True
+            }
+        }
+    
+    llm = LLM(model_name=model_name, model_params=model_params, use_cache=args.response_cache, token_margin=args.token_margin)
+    if llm.token_estimator is not None and not llm.token_estimator.is_calibrated:
+        calibration_texts = [query for query in queries if isinstance(query, str)] + ["\n".join(context) for context in all_context if context]
+        llm.calibrate_token_estimator(random.Random(0).sample(calibration_texts, min(50, len(calibration_texts))))
+
+    if args.prefix_cache and llm.is_local():
+        num_prefix_tokens = llm.set_prefix_cache(get_prompt_prefix(dataset, args.repetition_step, args.prompt_style))
+        if num_prefix_tokens:
+            print(f"Cached {num_prefix_tokens} prompt prefix tokens!")
+
+    return llm
 
-    if args.prompt_style == "react":
-        exp_name = f"{exp_name}_PS({args.prompt_style})"
 
+def get_query(cont_idx):
+
+    query = queries[cont_idx]       
+    if dataset.name == "amazon":
+        query = f"{query}\nRating:\n{query_ratings[cont_idx]}"
+    return query
+
+
+def run_k_sweep(model_name):
+
+    out_paths = {sweep_k: os.path.join(pred_path, f"{get_exp_name(args, dataset.tag, model_name, final_feature_list, retriever.retrieval_tag, sweep_k)}.json") for sweep_k in args.k_sweep}
+    all_res = {}
+    for sweep_k, out_path in out_paths.items():
+        if os.path.exists(out_path):
+            with open(out_path, "rb") as f:
+                all_res[sweep_k] = json.load(f)["golds"]
+        else:
+            all_res[sweep_k] = []
+
+    print(model_name)
+    out_paths = {sweep_k: out_path for sweep_k, out_path in out_paths.items() if len(all_res[sweep_k]) < len(queries)}
+    if not out_paths:
+        print("Experiment for this LLM is already concluded!")
+        return
+    start_idx = min(len(all_res[sweep_k]) for sweep_k in out_paths)
+
+    llm = load_llm(model_name)
+    print(f"Starting k-sweep {list(out_paths)} from sample no. {start_idx}")
+    start_time = time.time()
+    sys.stdout.flush()
+
+    for cont_idx in range(start_idx, len(queries)):
+
+        query = get_query(cont_idx)
+        features = prepared_features[cont_idx] if args.features else None
+
+        pending_ks = [sweep_k for sweep_k in out_paths if len(all_res[sweep_k]) == cont_idx]
+        prompts = []
+        for sweep_k in pending_ks:
+            ce_examples = None
+            if args.counter_examples:
+                ce_examples = [ce_example[:3 if sweep_k == 50 else 1] for ce_example in all_ce_examples[cont_idx]]
+            prompt = prepare_res_prompt(dataset, query, llm, examples=sweep_context[sweep_k][cont_idx], features=features, counter_examples=ce_examples, repetition_step=args.repetition_step, prompt_style=args.prompt_style)
+            prompts.append([{"role": "user", "content": prompt}])
+
+        start_bot_time = time.time()
+        all_outputs = llm.prompt_sweep(prompts, gen_params={"max_new_tokens": MAX_NEW_TOKENS})
+        end_bot_time = time.time()
+        id = ids[cont_idx] if dataset.name == "lamp" else cont_idx
+
+        for sweep_k, prompt, res in zip(pending_ks, prompts, all_outputs):
+            all_res[sweep_k].append({
+                    "id": id,
+                    "output": res,
+                    "prompt": prompt,
+                    "model_inf_time": round((end_bot_time - start_bot_time)/len(prompts), 2), 
+                    "k": retriever.sweep_ks[sweep_k][cont_idx],
+            })
+
+        if (cont_idx+1)%500==0 or (cont_idx+1)==len(queries):
+            print(cont_idx+1)
+            task = f"LaMP_{dataset.num}" if dataset.name == "lamp" else dataset.tag          
+            for sweep_k, out_path in out_paths.items():
+                with open(out_path, "w") as f:
+                    json.dump({
+                        "task": task,
+                        "golds": all_res[sweep_k]
+                    }, f)
+        sys.stdout.flush()
+
+    end_time = time.time()
+    print(f"Took {(end_time-start_time)/3600} hours!")
+    if llm.response_cache is not None:
+        print(f"Response cache: {llm.response_cache.stats()}")
+
+
+for model_name in LLMs:
+
+    if args.k_sweep:
+        run_k_sweep(model_name)
+        torch.cuda.empty_cache()
+        continue
+
+    exp_name = get_exp_name(args, dataset.tag, model_name, final_feature_list, retriever.retrieval_tag, k)
     out_path = os.path.join(pred_path, f"{exp_name}.json")
 
     if os.path.exists(out_path):
@@ -69,19 +205,7 @@ for model_name in LLMs:
         print("Batch openai jobs can only be done on the whole dataset!")
         continue
 
-    model_params = None
-    if model_name.endswith("70B"):
-        print("70B model, using quantization!")
-        model_params = {
-            "quantization": {
-                "load_in_4bit": True,
-                "bnb_4bit_compute_dtype": torch.float16,
-                "bnb_4bit_quant_type": "nf4",
-                "bnb_4bit_use_double_quant": True
-            }
-        }
-    
-    llm = LLM(model_name=model_name, model_params=model_params)
+    llm = load_llm(model_name)
 
     print(f"Starting from sample no. {len(all_res)}")
 
@@ -89,13 +213,12 @@ for model_name in LLMs:
     sys.stdout.flush() 
 
     cont_idx = copy.copy(len(all_res))
+    pending = []
+    flush_size = 500 if args.continuous_batching or (args.concurrency > 1 and not llm.is_local()) else args.batch_size
 
     for _ in range(len(queries) - len(all_res)):
         
-        query = queries[cont_idx]       
-        if dataset.name == "amazon":
-            query_rating, _ = dataset.get_ratings(cont_idx) 
-            query = f"{query}\nRating:\n{query_rating}"
+        query = get_query(cont_idx)
             
         context = all_context[cont_idx]    
 
@@ -107,7 +230,8 @@ for model_name in LLMs:
         else:
             ce_examples = None
 
-        start_bot_time = time.time() 
+        if not pending:
+            start_bot_time = time.time() 
 
         prompt = prepare_res_prompt(dataset, query, llm, examples=context, features=features, counter_examples=ce_examples, repetition_step=args.repetition_step, prompt_style=args.prompt_style)
         prompt = [{"role": "user", "content": prompt}]
@@ -123,14 +247,29 @@ for model_name in LLMs:
 
         else:
 
-            res = llm.prompt_chatbot(prompt, gen_params={"max_new_tokens": MAX_NEW_TOKENS})
+            pending.append((cont_idx, id, prompt))
+            if len(pending) < flush_size and (cont_idx+1)%500 != 0 and (cont_idx+1) != len(queries):
+                cont_idx += 1
+                continue
+
+            if len(pending) > 1 and args.continuous_batching:
+                all_outputs = llm.prompt_continuous([sample_prompt for _, _, sample_prompt in pending], gen_params={"max_new_tokens": MAX_NEW_TOKENS}, max_batch_size=args.batch_size, max_tokens_in_flight=args.max_tokens_in_flight)
+            elif len(pending) > 1 and not llm.is_local():
+                all_outputs = llm.prompt_concurrent([sample_prompt for _, _, sample_prompt in pending], gen_params={"max_new_tokens": MAX_NEW_TOKENS}, concurrency=args.concurrency)
+            elif len(pending) > 1:
+                all_outputs = llm.prompt_batch([sample_prompt for _, _, sample_prompt in pending], gen_params={"max_new_tokens": MAX_NEW_TOKENS}, batch_size=args.batch_size)
+            else:
+                all_outputs = [llm.prompt_chatbot(pending[0][2], gen_params={"max_new_tokens": MAX_NEW_TOKENS})]
             end_bot_time = time.time()
-            all_res.append({
-                    "id": id,
-                    "output": res,
-                    "prompt": prompt,
-                    "model_inf_time": round(end_bot_time - start_bot_time, 2), 
-            })
+            for (sample_idx, sample_id, sample_prompt), res in zip(pending, all_outputs):
+                all_res.append({
+                        "id": sample_id,
+                        "output": res,
+                        "prompt": sample_prompt,
+                        "model_inf_time": round((end_bot_time - start_bot_time)/len(pending), 2), 
+                        "k": retriever.chosen_ks[sample_idx],
+                })
+            pending = []
 
             if (cont_idx+1)%500==0 or (cont_idx+1)==len(queries):
                 print(cont_idx+1)
@@ -159,6 +298,8 @@ for model_name in LLMs:
 
         end_time = time.time()
         print(f"Took {(end_time-start_time)/3600} hours!")
+        if llm.response_cache is not None:
+            print(f"Response cache: {llm.response_cache.stats()}")
         del llm
         llm = []
         torch.cuda.empty_cache()
\ No newline at end of file
@@ -0,0 +1,156 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import threading
+from types import SimpleNamespace
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.async_client import AsyncLLMClient, RateLimiter, RATE_LIMITERS, is_retryable, get_retry_after
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    num_calls = 0
+
+    def log_message(self, *args):
+
+        pass
+
+    def send_json(self, status, payload, headers=None):
+
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        content = body["messages"][0]["content"]
+        StubHandler.num_calls += 1
+        if content == "bad":
+            return self.send_json(400, {"error": {"message": "bad request"}})
+        if StubHandler.num_calls % 4 == 0:
+            if StubHandler.num_calls % 8:
+                return self.send_json(429, {"error": {"message": "slow down"}}, {"Retry-After": "0.01"})
+            return self.send_json(503, {"error": {"message": "unavailable"}})
+        time.sleep(0.05)
+        self.send_json(200, {"id": "x", "object": "chat.completion", "created": 0, "model": body["model"],
+                             "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": f"echo {content}"}}]})
+
+
+@pytest.fixture(autouse=True)
+def reset_state():
+
+    StubHandler.num_calls = 0
+    RATE_LIMITERS.clear()
+    yield
+
+
+def start_server():
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_client(server, rpm=6000):
+
+    llm = SimpleNamespace(model_type="proprietary", family="GPT", model_name="GPT-4o", cfg={}, repo_id="gpt-stub", model_params={"api_key": "key"},
+                          name_token_var="max_tokens", count_tokens=lambda prompt: 10)
+    return AsyncLLMClient(llm, concurrency=8, rpm=rpm, base_url=f"http://127.0.0.1:{server.server_port}/v1", base_delay=0.05)
+
+
+def to_prompts(contents):
+
+    return [[{"role": "user", "content": content}] for content in contents]
+
+
+def test_retries_rate_limited_requests():
+
+    server = start_server()
+    client = make_client(server)
+    num_acquired = 0
+    acquire = client.limiter.acquire
+
+    async def counting_acquire(num_tokens):
+        nonlocal num_acquired
+        num_acquired += 1
+        await acquire(num_tokens)
+
+    client.limiter.acquire = counting_acquire
+    responses = client.run(to_prompts([str(i) for i in range(40)]), {"max_tokens": 5})
+    assert responses == [f"echo {i}" for i in range(40)]
+    assert client.num_retries > 0
+    assert num_acquired == 40 + client.num_retries
+    server.shutdown()
+
+
+def test_failed_request_keeps_other_responses():
+
+    server = start_server()
+    client = make_client(server)
+    responses = client.run(to_prompts(["a", "bad", "b"]), {"max_tokens": 5})
+    assert responses[0] == "echo a" and responses[2] == "echo b"
+    assert isinstance(responses[1], Exception)
+    server.shutdown()
+
+
+def test_only_transient_errors_are_retried():
+
+    assert is_retryable(SimpleNamespace(status_code=429))
+    assert is_retryable(SimpleNamespace(status_code=503))
+    assert not is_retryable(SimpleNamespace(status_code=400))
+    assert is_retryable(TimeoutError())
+    assert is_retryable(ConnectionError())
+    assert not is_retryable(KeyError("choices"))
+    assert not is_retryable(AttributeError("text"))
+
+
+def test_retry_after_header():
+
+    assert get_retry_after(SimpleNamespace(response=SimpleNamespace(headers={"retry-after": "2"}))) == 2.0
+    assert get_retry_after(SimpleNamespace(response=SimpleNamespace(headers={"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"}))) is None
+    assert get_retry_after(SimpleNamespace(response=SimpleNamespace(headers={}))) is None
+    assert get_retry_after(KeyError("choices")) is None
+
+
+def test_rate_limiter_is_shared_across_runs():
+
+    server = start_server()
+    first, second = make_client(server, rpm=600), make_client(server, rpm=600)
+    assert first.limiter is second.limiter
+    assert make_client(server, rpm=300).limiter is not first.limiter
+    server.shutdown()
+
+
+def test_token_bucket_keeps_state_across_event_loops():
+
+    now = 0.0
+    limiter = RateLimiter(rpm=60, clock=lambda: now)
+    for _ in range(10):
+        asyncio.run(limiter.acquire(1))
+    assert limiter.requests.tokens == 50
+    now = 5.0
+    asyncio.run(limiter.acquire(1))
+    assert limiter.requests.tokens == 54
+
+
+if __name__ == "__main__":
+
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            StubHandler.num_calls = 0
+            RATE_LIMITERS.clear()
+            test()
+            print(f"{name} passed!")
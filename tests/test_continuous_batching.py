@@ -0,0 +1,80 @@
+import os
+import sys
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.continuous_batching import ContinuousBatchingEngine
+
+EOS_TOKEN_ID = 7
+MAX_NEW_TOKENS = [5, 30, 12, 1, 20, 8, 40, 3, 15, 9, 25, 6]
+
+
+def make_model():
+
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=100, hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=4,
+                         num_key_value_heads=2, max_position_embeddings=512, eos_token_id=EOS_TOKEN_ID)
+    return LlamaForCausalLM(config).eval()
+
+
+def make_prompts():
+
+    generator = torch.Generator().manual_seed(1)
+    lengths = torch.randint(3, 40, (len(MAX_NEW_TOKENS),), generator=generator)
+    return [torch.randint(8, 100, (int(length),), generator=generator).tolist() for length in lengths]
+
+
+def reference_outputs(model, prompts, seed=None, **gen_params):
+
+    outputs = []
+    for input_ids, max_new_tokens in zip(prompts, MAX_NEW_TOKENS):
+        if seed is not None:
+            torch.manual_seed(seed)
+        inputs = torch.tensor([input_ids])
+        with torch.no_grad():
+            output = model.generate(inputs, attention_mask=torch.ones_like(inputs), max_new_tokens=max_new_tokens,
+                                    eos_token_id=EOS_TOKEN_ID, pad_token_id=0, **gen_params)
+        outputs.append([token for token in output[0, len(input_ids):].tolist() if token != EOS_TOKEN_ID])
+    return outputs
+
+
+def test_greedy_matches_generate():
+
+    model, prompts = make_model(), make_prompts()
+    expected = reference_outputs(model, prompts, do_sample=False)
+    for max_batch_size, max_tokens_in_flight in [(4, 10000), (3, 80), (12, 100000)]:
+        engine = ContinuousBatchingEngine(model, max_batch_size=max_batch_size, max_tokens_in_flight=max_tokens_in_flight)
+        assert engine.generate(prompts, MAX_NEW_TOKENS) == expected
+
+
+def test_seeded_sampling_matches_generate():
+
+    model, prompts = make_model(), make_prompts()
+    sampling_params = {"do_sample": True, "temperature": 0.7, "top_p": 0.9, "top_k": 20}
+    expected = reference_outputs(model, prompts, seed=0, **sampling_params)
+    engine = ContinuousBatchingEngine(model, max_batch_size=1, **sampling_params)
+    outputs = []
+    for input_ids, max_new_tokens in zip(prompts, MAX_NEW_TOKENS):
+        torch.manual_seed(0)
+        outputs.extend(engine.generate([input_ids], max_new_tokens))
+    assert outputs == expected
+
+
+def test_sampling_respects_max_new_tokens_in_batches():
+
+    model, prompts = make_model(), make_prompts()
+    engine = ContinuousBatchingEngine(model, max_batch_size=4, do_sample=True, temperature=1.0, top_p=0.9, top_k=20)
+    outputs = engine.generate(prompts, MAX_NEW_TOKENS)
+    assert all(len(output) <= max_new_tokens for output, max_new_tokens in zip(outputs, MAX_NEW_TOKENS))
+    assert engine.past_key_values is None
+
+
+if __name__ == "__main__":
+
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name} passed!")
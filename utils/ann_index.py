@@ -0,0 +1,79 @@
+import numpy as np
+
+
+def kmeans(embeds: np.ndarray, n_clusters: int, n_iter: int = 20, sample_size: int = 100000, seed: int = 0):
+
+    rng = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(embeds))
+    train = embeds if len(embeds) <= sample_size else embeds[rng.choice(len(embeds), sample_size, replace=False)]
+    centroids = train[rng.choice(len(train), n_clusters, replace=False)].astype(np.float32)
+
+    for _ in range(n_iter):
+        assignments = assign_clusters(train, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, train)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        if empty.any():
+            centroids[empty] = train[rng.choice(len(train), empty.sum(), replace=False)]
+
+    return centroids, assign_clusters(embeds, centroids)
+
+
+def assign_clusters(embeds: np.ndarray, centroids: np.ndarray, block_size: int = 8192) -> np.ndarray:
+
+    assignments = np.empty(len(embeds), dtype=np.int64)
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    for start in range(0, len(embeds), block_size):
+        block = embeds[start:start+block_size]
+        dists = centroid_norms[None, :] - 2 * block @ centroids.T
+        assignments[start:start+block_size] = dists.argmin(axis=1)
+    return assignments
+
+
+class IVFIndex:
+
+    def __init__(self, n_lists: int = None, n_probe: int = 8, seed: int = 0):
+
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.seed = seed
+        self.centroids = None
+        self.lists = None
+        self.embeds = None
+
+    def build(self, embeds: np.ndarray):
+
+        n_lists = self.n_lists or max(1, int(np.sqrt(len(embeds))))
+        self.embeds = embeds.astype(np.float32, copy=False)
+        self.centroids, assignments = kmeans(self.embeds, n_lists, seed=self.seed)
+        order = np.argsort(assignments, kind="stable")
+        bounds = np.searchsorted(assignments[order], np.arange(len(self.centroids) + 1))
+        self.lists = [order[bounds[c]:bounds[c+1]] for c in range(len(self.centroids))]
+        return self
+
+    def search(self, queries: np.ndarray, k: int, farthest: bool = False):
+
+        queries = -queries if farthest else queries
+        coarse = np.argsort(-(queries @ self.centroids.T), axis=1)
+
+        all_idxs = np.full((len(queries), k), -1, dtype=np.int64)
+        all_scores = np.full((len(queries), k), np.nan, dtype=np.float32)
+        for i, query in enumerate(queries):
+            n_probe = self.n_probe
+            candidates = np.concatenate([self.lists[c] for c in coarse[i, :n_probe]])
+            while len(candidates) < k and n_probe < len(self.lists):
+                n_probe += 1
+                candidates = np.concatenate([self.lists[c] for c in coarse[i, :n_probe]])
+            scores = self.embeds[candidates] @ query
+            top = np.argsort(-scores, kind="stable")[:k]
+            all_idxs[i, :len(top)] = candidates[top]
+            all_scores[i, :len(top)] = -scores[top] if farthest else scores[top]
+        return all_idxs, all_scores
+
+
+def recall_at_k(approx_idxs: np.ndarray, exact_idxs: np.ndarray) -> float:
+
+    hits = [len(set(a[a >= 0].tolist()) & set(e.tolist())) for a, e in zip(approx_idxs, exact_idxs)]
+    return float(np.sum(hits) / max(1, np.size(exact_idxs)))
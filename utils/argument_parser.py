@@ -10,9 +10,27 @@ def get_args():
     
     parser.add_argument("-d", "--dataset", default="amazon_Grocery_and_Gourmet_Food_2018", type=str)
     parser.add_argument("-k", "--top_k", default=-1, type=int)
+    parser.add_argument("-ks", "--k_sweep", nargs='+', type=int, default=None)
+    parser.add_argument("-at", "--adaptive_threshold", default=None, type=float)
+    parser.add_argument("-atr", "--adaptive_relative", default=False, action=argparse.BooleanOptionalAction)
+    parser.add_argument("-mk", "--min_k", default=1, type=int)
     parser.add_argument('-f', '--features', nargs='+', type=str, default=None)
     parser.add_argument("-r", "--retriever", default="contriever", type=str)
+    parser.add_argument("-cm", "--cascade_m", default=None, type=int)
+    parser.add_argument("-nw", "--num_workers", default=None, type=int)
+    parser.add_argument("-ec", "--embed_compression", default=None, type=str, choices=["fp16", "pq"])
+    parser.add_argument("-rw", "--rating_window", default=None, type=int)
+    parser.add_argument("-dd", "--dedup", default=None, type=float)
+    parser.add_argument("-bs", "--batch_size", default=1, type=int)
+    parser.add_argument("-cb", "--continuous_batching", default=False, action=argparse.BooleanOptionalAction)
+    parser.add_argument("-mtf", "--max_tokens_in_flight", default=16384, type=int)
+    parser.add_argument("-cc", "--concurrency", default=1, type=int)
+    parser.add_argument("-rc", "--response_cache", default=True, action=argparse.BooleanOptionalAction)
+    parser.add_argument("-tm", "--token_margin", default=0.1, type=float)
+    parser.add_argument("-pc", "--prefix_cache", default=False, action=argparse.BooleanOptionalAction)
+    parser.add_argument("-rb", "--retr_backend", default="torch", type=str, choices=["torch", "int8", "onnx", "auto"])
     parser.add_argument("-ce", "--counter_examples", default=None, type=int)
+    parser.add_argument("-cem", "--ce_mode", default="exact", type=str, choices=["exact", "ivf", "centroid", "cluster"])
     parser.add_argument("-rs", "--repetition_step", default=1, type=int)
     parser.add_argument("-ob", "--openai_batch", default=False, action=argparse.BooleanOptionalAction)
     parser.add_argument("-ps", "--prompt_style", default="regular", type=str)
@@ -46,7 +64,10 @@ def parse_args():
         final_feature_list = copy.copy(args.features)
 
     if args.counter_examples:
-        final_feature_list.append(f"CE({args.counter_examples})")
+        if args.ce_mode == "exact":
+            final_feature_list.append(f"CE({args.counter_examples})")
+        else:
+            final_feature_list.append(f"CE({args.counter_examples}-{args.ce_mode.upper()})")
 
     _, retr_texts, retr_gts = dataset.get_retr_data()
     if args.top_k == -1:
@@ -0,0 +1,189 @@
+import time
+import random
+import asyncio
+
+PROVIDER_LIMITS = {
+    "GPT": {"rpm": 500, "tpm": 200000},
+    "CLAUDE": {"rpm": 50, "tpm": 40000},
+    "GEMINI": {"rpm": 60, "tpm": 1000000},
+    "GROQ": {"rpm": 30, "tpm": 6000},
+    "PPLX": {"rpm": 50, "tpm": 100000},
+    "TGTR": {"rpm": 60, "tpm": 100000},
+}
+RETRYABLE_ERRORS = {"APIConnectionError", "APITimeoutError", "TransportError", "ServiceUnavailable", "DeadlineExceeded"}
+RATE_LIMITERS = {}
+
+
+class TokenBucket:
+
+    def __init__(self, rate_per_min: float, clock=time.monotonic):
+
+        self.capacity = rate_per_min
+        self.rate = rate_per_min / 60
+        self.tokens = rate_per_min
+        self.clock = clock
+        self.updated = clock()
+        self.lock = None
+        self.loop = None
+
+    async def acquire(self, amount: float = 1):
+
+        amount = min(amount, self.capacity)
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.lock = asyncio.Lock()
+            self.loop = loop
+        async with self.lock:
+            while True:
+                now = self.clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class RateLimiter:
+
+    def __init__(self, rpm: float = None, tpm: float = None, clock=time.monotonic):
+
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = TokenBucket(rpm, clock) if rpm else None
+        self.tokens = TokenBucket(tpm, clock) if tpm else None
+
+    async def acquire(self, num_tokens: int):
+
+        if self.requests:
+            await self.requests.acquire(1)
+        if self.tokens:
+            await self.tokens.acquire(num_tokens)
+
+
+def get_status_code(error: Exception):
+
+    for status in [getattr(error, "status_code", None), getattr(getattr(error, "response", None), "status_code", None), getattr(error, "code", None)]:
+        if isinstance(status, int):
+            return status
+    return None
+
+
+def get_retry_after(error: Exception):
+
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        return max(0.0, float(headers.get("retry-after")))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error: Exception) -> bool:
+
+    status = get_status_code(error)
+    if status is not None:
+        return status == 429 or status >= 500
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    return any(cls.__name__ in RETRYABLE_ERRORS for cls in type(error).__mro__)
+
+
+def get_rate_limiter(key, rpm: float = None, tpm: float = None) -> RateLimiter:
+
+    limiter = RATE_LIMITERS.get(key)
+    if limiter is None or (limiter.rpm, limiter.tpm) != (rpm, tpm):
+        limiter = RATE_LIMITERS[key] = RateLimiter(rpm, tpm)
+    return limiter
+
+
+class AsyncLLMClient:
+
+    def __init__(self, llm, concurrency: int = 8, rpm: float = None, tpm: float = None, base_url: str = None, max_retries: int = 6, base_delay: float = 1.0, max_delay: float = 60.0):
+
+        self.llm = llm
+        self.provider = llm.model_type if llm.model_type in ["PPLX", "GROQ", "TGTR"] else llm.family
+        if self.provider not in PROVIDER_LIMITS:
+            raise ValueError(f"No async client for {llm.model_name}!")
+        limits = PROVIDER_LIMITS[self.provider]
+        self.rpm = rpm or float(llm.cfg.get("rpm", limits["rpm"]))
+        self.tpm = tpm or float(llm.cfg.get("tpm", limits["tpm"]))
+        self.concurrency = concurrency
+        self.base_url = base_url
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.num_retries = 0
+        self.limiter = get_rate_limiter((self.provider, llm.repo_id, base_url), self.rpm, self.tpm)
+
+    def _init_client(self):
+
+        model_params = dict(self.llm.model_params)
+        if self.base_url:
+            model_params["base_url"] = self.base_url
+        if self.provider == "CLAUDE":
+            from anthropic import AsyncAnthropic
+            return AsyncAnthropic(max_retries=0, **model_params)
+        elif self.provider == "GEMINI":
+            return self.llm.model
+        else:
+            from openai import AsyncOpenAI
+            return AsyncOpenAI(max_retries=0, **model_params)
+
+    async def _request(self, client, prompt, gen_params):
+
+        if self.provider == "CLAUDE":
+            messages, sys_msg = self.llm.claude_messages(prompt)
+            if sys_msg is not None:
+                response = await client.messages.create(model=self.llm.repo_id, messages=messages, system=sys_msg, **gen_params)
+            else:
+                response = await client.messages.create(model=self.llm.repo_id, messages=messages, **gen_params)
+            return response.content[0].text
+        elif self.provider == "GEMINI":
+            import google.generativeai as genai
+            response = await client.generate_content_async(self.llm.gemini_messages(prompt), generation_config=genai.types.GenerationConfig(**gen_params))
+            return response.text
+        else:
+            response = await client.chat.completions.create(model=self.llm.repo_id, messages=prompt, **gen_params)
+            return response.choices[0].message.content
+
+    async def _request_with_retry(self, client, prompt, gen_params):
+
+        num_tokens = self.estimate_tokens(prompt, gen_params)
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire(num_tokens)
+            try:
+                return await self._request(client, prompt, gen_params)
+            except Exception as error:
+                if attempt == self.max_retries or not is_retryable(error):
+                    raise
+                delay = get_retry_after(error)
+                if delay is None:
+                    delay = min(self.max_delay, self.base_delay * 2 ** attempt) * (1 + random.random())
+                print(f"Request failed with {get_status_code(error) or type(error).__name__}, retrying in {delay:.1f} seconds!")
+                self.num_retries += 1
+                await asyncio.sleep(delay)
+
+    def estimate_tokens(self, prompt, gen_params) -> int:
+
+        return self.llm.count_tokens(prompt) + gen_params.get(self.llm.name_token_var, 0)
+
+    async def _run(self, prompts, gen_params):
+
+        client = self._init_client()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def process(prompt):
+            async with semaphore:
+                return await self._request_with_retry(client, prompt, gen_params)
+
+        try:
+            return await asyncio.gather(*[process(prompt) for prompt in prompts], return_exceptions=True)
+        finally:
+            if hasattr(client, "close"):
+                await client.close()
+
+    def run(self, prompts, gen_params):
+
+        return asyncio.run(self._run(prompts, gen_params))
@@ -0,0 +1,100 @@
+import os
+import re
+import json
+
+import numpy as np
+from scipy import sparse
+from typing import List
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+
+    return TOKEN_PATTERN.findall(str(text).lower())
+
+
+class BM25Index:
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+
+        self.k1 = k1
+        self.b = b
+        self.vocab = {}
+        self.weights = None
+        self.offsets = None
+
+    @property
+    def num_users(self) -> int:
+
+        return len(self.offsets) - 1
+
+    def build(self, retr_texts: List[List[str]]):
+
+        rows, cols, counts = [], [], []
+        doc_id = 0
+        for docs in retr_texts:
+            for doc in docs:
+                token_ids = np.array([self.vocab.setdefault(token, len(self.vocab)) for token in tokenize(doc)], dtype=np.int64)
+                term_ids, term_counts = np.unique(token_ids, return_counts=True)
+                rows.extend([doc_id] * len(term_ids))
+                cols.extend(term_ids.tolist())
+                counts.extend(term_counts.tolist())
+                doc_id += 1
+
+        doc_counts = np.array([len(docs) for docs in retr_texts], dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(doc_counts)])
+        tf = sparse.csr_matrix((np.array(counts, dtype=np.float32), (rows, cols)), shape=(doc_id, max(1, len(self.vocab))))
+
+        owners = np.repeat(np.arange(len(retr_texts)), doc_counts)
+        owner_matrix = sparse.csr_matrix((np.ones(doc_id, dtype=np.float32), (owners, np.arange(doc_id))), shape=(len(retr_texts), doc_id))
+        doc_freqs = (owner_matrix @ (tf > 0).astype(np.float32)).tocsr()
+        doc_lens = np.asarray(tf.sum(axis=1)).ravel()
+        avg_doc_lens = np.bincount(owners, weights=doc_lens, minlength=len(retr_texts)) / np.maximum(doc_counts, 1)
+
+        tf = tf.tocoo()
+        owner_of_entry = owners[tf.row]
+        df = np.asarray(doc_freqs[owner_of_entry, tf.col]).ravel()
+        n_docs = doc_counts[owner_of_entry]
+        idf = np.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+        norm = self.k1 * (1 - self.b + self.b * doc_lens[tf.row] / np.maximum(avg_doc_lens[owner_of_entry], 1e-6))
+        values = idf * tf.data * (self.k1 + 1) / (tf.data + norm)
+        self.weights = sparse.csr_matrix((values.astype(np.float32), (tf.row, tf.col)), shape=tf.shape)
+        return self
+
+    def query_matrix(self, queries: List[str]) -> sparse.csr_matrix:
+
+        rows, cols = [], []
+        for i, query in enumerate(queries):
+            term_ids = [self.vocab[token] for token in tokenize(query) if token in self.vocab]
+            rows.extend([i] * len(term_ids))
+            cols.extend(term_ids)
+        return sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=(len(queries), self.weights.shape[1]))
+
+    def user_scores(self, queries: List[str], users: np.ndarray) -> np.ndarray:
+
+        users = np.asarray(users, dtype=np.int64)
+        doc_counts = self.offsets[users + 1] - self.offsets[users]
+        doc_rows = np.concatenate([np.arange(self.offsets[u], self.offsets[u + 1]) for u in users] + [np.zeros(0, dtype=np.int64)])
+        owners = np.repeat(np.arange(len(queries)), doc_counts)
+        query_rows = self.query_matrix(queries)[owners]
+        return np.asarray(self.weights[doc_rows].multiply(query_rows).sum(axis=1)).ravel()
+
+    def save(self, save_dir: str):
+
+        os.makedirs(save_dir, exist_ok=True)
+        sparse.save_npz(os.path.join(save_dir, "weights.npz"), self.weights)
+        np.save(os.path.join(save_dir, "offsets.npy"), self.offsets)
+        with open(os.path.join(save_dir, "vocab.json"), "w") as f:
+            json.dump({"k1": self.k1, "b": self.b, "vocab": self.vocab}, f)
+
+    @classmethod
+    def load(cls, save_dir: str):
+
+        with open(os.path.join(save_dir, "vocab.json"), "r") as f:
+            meta = json.load(f)
+        index = cls(meta["k1"], meta["b"])
+        index.vocab = meta["vocab"]
+        index.weights = sparse.load_npz(os.path.join(save_dir, "weights.npz")).tocsr()
+        index.offsets = np.load(os.path.join(save_dir, "offsets.npy"))
+        return index
@@ -0,0 +1,195 @@
+from collections import deque
+
+import torch
+import torch.nn.functional as F
+from typing import List, Union
+
+SAMPLING_DEFAULTS = {"do_sample": False, "temperature": 1.0, "top_p": 1.0, "top_k": 50}
+
+
+def cache_to_tuple(past_key_values):
+
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    if hasattr(past_key_values, "layers"):
+        return tuple((layer.keys, layer.values) for layer in past_key_values.layers)
+    return tuple(tuple(layer[:2]) for layer in past_key_values)
+
+
+def tuple_to_cache(past_key_values):
+
+    from transformers import DynamicCache
+
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(past_key_values)
+    return DynamicCache(past_key_values)
+
+
+class _Sequence:
+
+    def __init__(self, idx: int, input_ids: List[int], max_new_tokens: int):
+
+        self.idx = idx
+        self.input_ids = input_ids
+        self.max_new_tokens = max_new_tokens
+        self.output_ids = []
+        self.past_key_values = None
+        self.length = 0
+        self.finished = False
+
+    @property
+    def reserved_tokens(self) -> int:
+
+        return len(self.input_ids) + self.max_new_tokens
+
+
+class ContinuousBatchingEngine:
+
+    def __init__(self, model, eos_token_ids: Union[int, List[int]] = None, max_batch_size: int = 8, max_tokens_in_flight: int = 16384, prefix_cache=None,
+                 do_sample: bool = False, temperature: float = 1.0, top_p: float = 1.0, top_k: int = 50):
+
+        if do_sample and temperature <= 0:
+            raise ValueError(f"Sampling needs a positive temperature, got {temperature}!")
+        self.model = model
+        self.do_sample = do_sample
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.prefix_cache = prefix_cache
+        if eos_token_ids is None:
+            eos_token_ids = model.generation_config.eos_token_id
+        if eos_token_ids is None:
+            eos_token_ids = []
+        self.eos_token_ids = set([eos_token_ids] if isinstance(eos_token_ids, int) else eos_token_ids)
+        self.max_batch_size = max_batch_size
+        self.max_tokens_in_flight = max_tokens_in_flight
+        self.device = model.device
+        self.past_key_values = None
+        self.num_steps = 0
+
+    def _next_token(self, logits: torch.Tensor) -> int:
+
+        if not self.do_sample:
+            return int(logits.argmax())
+        logits = logits.float() / self.temperature
+        if self.top_k:
+            kth_logit = torch.topk(logits, min(self.top_k, logits.numel())).values[-1]
+            logits = logits.masked_fill(logits < kth_logit, float("-inf"))
+        if self.top_p < 1.0:
+            sorted_logits, sorted_idxs = torch.sort(logits, descending=True)
+            sorted_probs = sorted_logits.softmax(-1)
+            logits[sorted_idxs[sorted_probs.cumsum(-1) - sorted_probs >= self.top_p]] = float("-inf")
+        return int(torch.multinomial(logits.softmax(-1), 1))
+
+    def _append_token(self, seq: _Sequence, logits: torch.Tensor):
+
+        token = self._next_token(logits)
+        seq.output_ids.append(token)
+        seq.finished = token in self.eos_token_ids or len(seq.output_ids) >= seq.max_new_tokens
+
+    def _prefill(self, seq: _Sequence):
+
+        num_cached = self.prefix_cache.match(seq.input_ids) if self.prefix_cache is not None else 0
+        with torch.no_grad():
+            if num_cached:
+                outputs = self.model(input_ids=torch.tensor([seq.input_ids[num_cached:]], device=self.device),
+                                     past_key_values=self.prefix_cache.get(num_cached), use_cache=True)
+            else:
+                outputs = self.model(input_ids=torch.tensor([seq.input_ids], device=self.device), use_cache=True)
+        seq.past_key_values = cache_to_tuple(outputs.past_key_values)
+        seq.length = len(seq.input_ids)
+        self._append_token(seq, outputs.logits[0, -1])
+
+    @property
+    def cache_length(self) -> int:
+
+        return 0 if self.past_key_values is None else self.past_key_values[0][0].shape[2]
+
+    def _admit(self, running: List[_Sequence], admitted: List[_Sequence]) -> List[_Sequence]:
+
+        cache_length = max([self.cache_length] + [seq.length for seq in admitted])
+        past_key_values = []
+        for layer in range(len(admitted[0].past_key_values)):
+            keys, values = [], []
+            if running:
+                pad = cache_length - self.cache_length
+                keys.append(F.pad(self.past_key_values[layer][0], (0, 0, pad, 0)) if pad else self.past_key_values[layer][0])
+                values.append(F.pad(self.past_key_values[layer][1], (0, 0, pad, 0)) if pad else self.past_key_values[layer][1])
+            for seq in admitted:
+                keys.append(F.pad(seq.past_key_values[layer][0], (0, 0, cache_length - seq.length, 0)))
+                values.append(F.pad(seq.past_key_values[layer][1], (0, 0, cache_length - seq.length, 0)))
+            past_key_values.append((torch.cat(keys), torch.cat(values)))
+        for seq in admitted:
+            seq.past_key_values = None
+        self.past_key_values = tuple(past_key_values)
+        return running + admitted
+
+    def _decode_step(self, running: List[_Sequence]):
+
+        cache_length = self.cache_length
+        attention_mask = torch.zeros((len(running), cache_length + 1), dtype=torch.long, device=self.device)
+        for i, seq in enumerate(running):
+            attention_mask[i, cache_length - seq.length:] = 1
+        input_ids = torch.tensor([[seq.output_ids[-1]] for seq in running], device=self.device)
+        position_ids = torch.tensor([[seq.length] for seq in running], device=self.device)
+
+        with torch.no_grad():
+            outputs = self.model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                                 past_key_values=tuple_to_cache(self.past_key_values), use_cache=True)
+        self.past_key_values = cache_to_tuple(outputs.past_key_values)
+        for i, seq in enumerate(running):
+            seq.length += 1
+            self._append_token(seq, outputs.logits[i, -1])
+        self.num_steps += 1
+
+    def _can_admit(self, seq: _Sequence, running: List[_Sequence]) -> bool:
+
+        if not running:
+            return True
+        in_flight = sum(running_seq.reserved_tokens for running_seq in running)
+        return len(running) < self.max_batch_size and in_flight + seq.reserved_tokens <= self.max_tokens_in_flight
+
+    def _finish(self, seqs: List[_Sequence], outputs: List[List[int]]) -> List[_Sequence]:
+
+        for seq in seqs:
+            if seq.finished:
+                outputs[seq.idx] = [token for token in seq.output_ids if token not in self.eos_token_ids]
+                seq.past_key_values = None
+        return [seq for seq in seqs if not seq.finished]
+
+    def _evict(self, running: List[_Sequence], outputs: List[List[int]]) -> List[_Sequence]:
+
+        kept = self._finish(running, outputs)
+        if len(kept) == len(running):
+            return running
+        if not kept:
+            self.past_key_values = None
+            return kept
+        rows = torch.tensor([i for i, seq in enumerate(running) if not seq.finished], device=self.device)
+        start = self.cache_length - max(seq.length for seq in kept)
+        self.past_key_values = tuple((keys[rows, :, start:], values[rows, :, start:]) for keys, values in self.past_key_values)
+        return kept
+
+    def generate(self, prompts: List[List[int]], max_new_tokens: Union[int, List[int]]) -> List[List[int]]:
+
+        if isinstance(max_new_tokens, int):
+            max_new_tokens = [max_new_tokens] * len(prompts)
+        waiting = deque(_Sequence(i, input_ids, max_tokens) for i, (input_ids, max_tokens) in enumerate(zip(prompts, max_new_tokens)))
+        running = []
+        outputs = [None] * len(prompts)
+
+        self.past_key_values = None
+        while waiting or running:
+            admitted = []
+            while waiting and self._can_admit(waiting[0], running + admitted):
+                seq = waiting.popleft()
+                self._prefill(seq)
+                admitted.append(seq)
+            admitted = self._finish(admitted, outputs)
+            if admitted:
+                running = self._admit(running, admitted)
+            if running:
+                self._decode_step(running)
+                running = self._evict(running, outputs)
+
+        return outputs
@@ -0,0 +1,97 @@
+import os
+import json
+import zlib
+
+import numpy as np
+from typing import List
+
+from utils.bm25 import tokenize
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+
+def shingle_hashes(text: str, shingle_size: int = 3) -> np.ndarray:
+
+    tokens = tokenize(text)
+    if len(tokens) < shingle_size:
+        shingles = [" ".join(tokens)]
+    else:
+        shingles = [" ".join(tokens[i:i+shingle_size]) for i in range(len(tokens) - shingle_size + 1)]
+    return np.unique(np.array([zlib.crc32(shingle.encode("utf-8")) for shingle in shingles], dtype=np.uint64))
+
+
+class MinHashLSH:
+
+    def __init__(self, num_perm: int = 64, num_bands: int = 16, threshold: float = 0.8, shingle_size: int = 3, seed: int = 0):
+
+        if num_perm % num_bands != 0:
+            raise ValueError(f"Number of permutations {num_perm} is not divisible by {num_bands} bands!")
+        self.num_perm = num_perm
+        self.num_bands = num_bands
+        self.rows = num_perm // num_bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, MAX_HASH, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, MAX_HASH, num_perm, dtype=np.uint64)
+
+    def signatures(self, docs: List[str]) -> np.ndarray:
+
+        sigs = np.empty((len(docs), self.num_perm), dtype=np.uint64)
+        for i, doc in enumerate(docs):
+            hashes = shingle_hashes(doc, self.shingle_size)
+            sigs[i] = ((self.a[:, None] * hashes[None, :] + self.b[:, None]) % MERSENNE_PRIME).min(axis=1)
+        return sigs
+
+    def keep_idxs(self, docs: List[str]) -> List[int]:
+
+        sigs = self.signatures(docs)
+        buckets = [{} for _ in range(self.num_bands)]
+        kept = []
+        for i, sig in enumerate(sigs):
+            keys = [sig[band*self.rows:(band+1)*self.rows].tobytes() for band in range(self.num_bands)]
+            candidates = {j for band, key in enumerate(keys) for j in buckets[band].get(key, [])}
+            if any(np.mean(sigs[j] == sig) >= self.threshold for j in candidates):
+                continue
+            kept.append(i)
+            for band, key in enumerate(keys):
+                buckets[band].setdefault(key, []).append(i)
+        return kept
+
+
+def dedup_profiles(dataset_tag: str, retr_texts: List[List[str]], retr_gts: List[List[str]], threshold: float = 0.8, save_dir: str = os.path.join("files", "dedup")) -> List[List[int]]:
+
+    os.makedirs(save_dir, exist_ok=True)
+    save_path = os.path.join(save_dir, f"{dataset_tag}_{threshold}.json")
+    if os.path.exists(save_path):
+        with open(save_path, "r") as f:
+            kept_idxs = json.load(f)
+        if len(kept_idxs) == len(retr_texts):
+            return kept_idxs
+
+    print("Removing near-duplicate profile documents!")
+    lsh = MinHashLSH(threshold=threshold)
+    kept_idxs = []
+    for texts, gts in zip(retr_texts, retr_gts):
+        docs = [text if text == gt else f"{text} {gt}" for text, gt in zip(texts, map(str, gts))]
+        kept_idxs.append(lsh.keep_idxs(docs))
+
+    with open(save_path, "w") as f:
+        json.dump(kept_idxs, f)
+    return kept_idxs
+
+
+def dedup_savings(retr_texts: List[List[str]], retr_gts: List[List[str]], kept_idxs: List[List[int]]) -> dict:
+
+    total_docs = sum(len(texts) for texts in retr_texts)
+    removed_docs, removed_words, total_words = 0, 0, 0
+    for texts, gts, kept in zip(retr_texts, retr_gts, kept_idxs):
+        kept = set(kept)
+        for j, (text, gt) in enumerate(zip(texts, map(str, gts))):
+            num_words = len(tokenize(text)) + (len(tokenize(gt)) if text != gt else 0)
+            total_words += num_words
+            if j not in kept:
+                removed_docs += 1
+                removed_words += num_words
+    return {"total_docs": total_docs, "removed_docs": removed_docs, "total_words": total_words, "removed_words": removed_words}
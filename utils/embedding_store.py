@@ -0,0 +1,118 @@
+import os
+import json
+import fcntl
+import hashlib
+from contextlib import contextmanager
+
+import numpy as np
+from typing import List
+
+
+class EmbeddingStore:
+
+    def __init__(self, encoder_name: str, store_dir: str = os.path.join("files", "embeddings"), dtype: str = "float32"):
+
+        self.encoder_name = encoder_name
+        self.store_dir = os.path.join(store_dir, encoder_name.replace("/", "_"))
+        os.makedirs(self.store_dir, exist_ok=True)
+        self.data_path = os.path.join(self.store_dir, "embeds.bin")
+        self.index_path = os.path.join(self.store_dir, "index.txt")
+        self.meta_path = os.path.join(self.store_dir, "meta.json")
+        self.lock_path = os.path.join(self.store_dir, "store.lock")
+        self.dtype = np.dtype(dtype)
+        self.dim = None
+        self.index = {}
+        self._data = None
+        self._load()
+
+    @staticmethod
+    def hash_text(text: str) -> str:
+
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    @contextmanager
+    def _lock(self):
+
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load(self):
+
+        with self._lock():
+            self._sync()
+
+    def _sync(self):
+
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r") as f:
+                meta = json.load(f)
+            self.dim = meta["dim"]
+            self.dtype = np.dtype(meta["dtype"])
+        if self.dim is None:
+            return
+        keys = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as f:
+                keys = [line[:-1] for line in f if line.endswith("\n")]
+        row_bytes = self.dim * self.dtype.itemsize
+        data_size = os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+        num_rows = min(len(keys), data_size // row_bytes)
+        if data_size != num_rows * row_bytes:
+            with open(self.data_path, "ab") as f:
+                f.truncate(num_rows * row_bytes)
+        if len(keys) != num_rows or (os.path.exists(self.index_path) and os.path.getsize(self.index_path) != sum(len(key) + 1 for key in keys)):
+            with open(self.index_path, "w") as f:
+                f.write("".join(f"{key}\n" for key in keys[:num_rows]))
+        self.index = {key: row for row, key in enumerate(keys[:num_rows])}
+        self._data = None
+
+    def _get_data(self):
+
+        if self._data is None or len(self._data) < len(self.index):
+            self._data = np.memmap(self.data_path, dtype=self.dtype, mode="r", shape=(len(self.index), self.dim))
+        return self._data
+
+    def __len__(self):
+
+        return len(self.index)
+
+    def lookup(self, texts: List[str]):
+
+        keys = [self.hash_text(text) for text in texts]
+        rows = np.array([self.index.get(key, -1) for key in keys], dtype=np.int64)
+        found = rows >= 0
+        if self.dim is None or not found.any():
+            return None, found
+        embeds = np.zeros((len(texts), self.dim), dtype=self.dtype)
+        embeds[found] = self._get_data()[rows[found]]
+        return embeds, found
+
+    def add(self, texts: List[str], embeds: np.ndarray):
+
+        if len(texts) == 0:
+            return
+        with self._lock():
+            self._sync()
+            if self.dim is None:
+                self.dim = int(embeds.shape[1])
+                with open(self.meta_path, "w") as f:
+                    json.dump({"encoder": self.encoder_name, "dim": self.dim, "dtype": self.dtype.name}, f)
+
+            new_keys, new_rows = [], []
+            for i, text in enumerate(texts):
+                key = self.hash_text(text)
+                if key not in self.index:
+                    self.index[key] = len(self.index)
+                    new_keys.append(key)
+                    new_rows.append(i)
+            if not new_keys:
+                return
+            with open(self.data_path, "ab") as f:
+                f.write(np.ascontiguousarray(embeds[new_rows], dtype=self.dtype).tobytes())
+            with open(self.index_path, "a") as f:
+                f.write("".join(f"{key}\n" for key in new_keys))
+            self._data = None
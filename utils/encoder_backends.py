@@ -0,0 +1,92 @@
+import os
+
+import numpy as np
+import torch
+from typing import List
+
+
+def get_device(device: str = None) -> str:
+
+    if device:
+        return device
+    return "cuda:0" if torch.cuda.is_available() else "cpu"
+
+
+def resolve_backend(backend: str, device: str = None) -> str:
+
+    if backend == "auto":
+        return "torch" if get_device(device).startswith("cuda") else "int8"
+    if backend not in ["torch", "int8", "onnx"]:
+        raise ValueError(f"Unknown encoder backend: {backend}")
+    return backend
+
+
+def quantize_int8(model):
+
+    model = model.to("cpu")
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class _TokenEmbeddings(torch.nn.Module):
+
+    def __init__(self, auto_model):
+
+        super().__init__()
+        self.auto_model = auto_model
+
+    def forward(self, input_ids, attention_mask, token_type_ids=None):
+
+        return self.auto_model(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)[0]
+
+
+class OnnxEncoder:
+
+    def __init__(self, st_model, onnx_path: str, num_threads: int = None):
+
+        import onnxruntime as ort
+
+        self.st_model = st_model.to("cpu")
+        if not os.path.exists(onnx_path):
+            self._export(onnx_path)
+        sess_options = ort.SessionOptions()
+        if num_threads:
+            sess_options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(onnx_path, sess_options, providers=["CPUExecutionProvider"])
+        self.input_names = [inp.name for inp in self.session.get_inputs()]
+
+    def __getattr__(self, name):
+
+        return getattr(self.st_model, name)
+
+    def _export(self, onnx_path: str):
+
+        os.makedirs(os.path.dirname(onnx_path), exist_ok=True)
+        features = self.st_model.tokenize(["Export the encoder graph."])
+        input_names = [name for name in ["input_ids", "attention_mask", "token_type_ids"] if name in features]
+        dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+        dynamic_axes["token_embeddings"] = {0: "batch", 1: "sequence"}
+        with torch.no_grad():
+            torch.onnx.export(_TokenEmbeddings(self.st_model[0].auto_model).eval(), ({name: features[name] for name in input_names},),
+                              onnx_path, input_names=input_names, output_names=["token_embeddings"],
+                              dynamic_axes=dynamic_axes, opset_version=14)
+        print(f"Exported encoder to {onnx_path}!")
+
+    def encode(self, sentences: List[str], batch_size: int = 32, convert_to_numpy: bool = True, **kwargs) -> np.ndarray:
+
+        if isinstance(sentences, str):
+            return self.encode([sentences], batch_size)[0]
+        order = np.argsort([-len(sentence) for sentence in sentences], kind="stable")
+        embeds = None
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start+batch_size]
+            features = self.st_model.tokenize([sentences[i] for i in batch])
+            token_embeddings = self.session.run(None, {name: features[name].numpy() for name in self.input_names})[0]
+            features = {"token_embeddings": torch.from_numpy(token_embeddings), "attention_mask": features["attention_mask"]}
+            with torch.no_grad():
+                for module in list(self.st_model)[1:]:
+                    features = module(features)
+            batch_embeds = features["sentence_embedding"].numpy()
+            if embeds is None:
+                embeds = np.empty((len(sentences), batch_embeds.shape[1]), dtype=np.float32)
+            embeds[batch] = batch_embeds
+        return embeds
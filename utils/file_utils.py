@@ -37,13 +37,44 @@ def parse_filename(file, dataset_tag):
     model = params[0]
     rs = re.findall(r'\((.*?)\)', params[3])[0]
 
-    if len(params) > 5:
-        ps = re.findall(r'\((.*?)\)', params[5])[0]
+    extra_params = {"PS": "regular"}
+    for param in params[5:]:
+        match = re.match(r'^(\w+?)\((.*?)\)$', param)
+        if match:
+            extra_params[match.group(1)] = match.group(2)
 
-    else:
-        ps = "regular"
+    return {"model": model, "retriever": retriever, "features": features, "RS": rs, "k": k, **extra_params}
+
+def get_retrieval_tag(model, backend="torch", cascade_m=None, compression=None, pq_subspaces=16, rating_window=None):
+
+    if model == "bm25":
+        backend, cascade_m, compression = "torch", None, None
+    retrieval_tag = model if backend == "torch" else f"{model}-{backend}"
+    if cascade_m:
+        retrieval_tag = f"{retrieval_tag}-C{cascade_m}"
+    if compression == "fp16":
+        retrieval_tag = f"{retrieval_tag}-FP16"
+    elif compression == "pq":
+        retrieval_tag = f"{retrieval_tag}-PQ{pq_subspaces}"
+    if rating_window is not None:
+        retrieval_tag = f"{retrieval_tag}-RW{rating_window}"
+    return retrieval_tag
+
+def get_exp_name(args, dataset_tag, model_name, final_feature_list, retrieval_tag, k):
+
+    exp_name = f"{dataset_tag}_{model_name}_{final_feature_list}_{retrieval_tag}_RS({args.repetition_step})_K({k})"
+
+    if args.prompt_style == "react":
+        exp_name = f"{exp_name}_PS({args.prompt_style})"
+
+    if args.dedup is not None:
+        exp_name = f"{exp_name}_DD({args.dedup})"
+
+    if args.adaptive_threshold is not None:
+        threshold_tag = f"r{args.adaptive_threshold}" if args.adaptive_relative else args.adaptive_threshold
+        exp_name = f"{exp_name}_AK({threshold_tag})"
 
-    return {"model": model, "retriever": retriever, "features": features, "RS": rs, "k": k, "PS": ps}
+    return exp_name
 
 def oai_get_or_create_file(client, filename):
 
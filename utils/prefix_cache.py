@@ -0,0 +1,35 @@
+import torch
+from typing import List
+
+from utils.continuous_batching import cache_to_tuple, tuple_to_cache
+
+
+class PrefixCache:
+
+    def __init__(self, model, input_ids: List[int], base=None):
+
+        self.input_ids = list(input_ids)
+        num_cached = base.match(self.input_ids) if base is not None else 0
+        with torch.no_grad():
+            outputs = model(input_ids=torch.tensor([self.input_ids[num_cached:]], device=model.device),
+                            past_key_values=base.get(num_cached) if base is not None else None, use_cache=True)
+        self.past_key_values = cache_to_tuple(outputs.past_key_values)
+
+    def __len__(self):
+
+        return len(self.input_ids)
+
+    def match(self, input_ids: List[int]) -> int:
+
+        num_shared = 0
+        for cached_id, input_id in zip(self.input_ids, input_ids[:-1]):
+            if cached_id != input_id:
+                break
+            num_shared += 1
+        return num_shared
+
+    def get(self, length: int):
+
+        if length == 0:
+            return None
+        return tuple_to_cache(tuple((keys[:, :, :length], values[:, :, :length]) for keys, values in self.past_key_values))
@@ -0,0 +1,78 @@
+import os
+
+import numpy as np
+
+from utils.ann_index import kmeans, assign_clusters
+
+
+class ProductQuantizer:
+
+    def __init__(self, n_subspaces: int = 16, n_centroids: int = 256, seed: int = 0):
+
+        if n_centroids > 256:
+            raise ValueError("Product quantization codes are stored as uint8, use at most 256 centroids!")
+        self.n_subspaces = n_subspaces
+        self.n_centroids = n_centroids
+        self.seed = seed
+        self.codebooks = None
+
+    @property
+    def is_fitted(self) -> bool:
+
+        return self.codebooks is not None
+
+    def _split(self, embeds: np.ndarray) -> np.ndarray:
+
+        if embeds.shape[1] % self.n_subspaces != 0:
+            raise ValueError(f"Embedding dimension {embeds.shape[1]} is not divisible by {self.n_subspaces} subspaces!")
+        return embeds.reshape(len(embeds), self.n_subspaces, -1).astype(np.float32, copy=False)
+
+    def fit(self, embeds: np.ndarray):
+
+        subspaces = self._split(embeds)
+        self.codebooks = np.stack([kmeans(subspaces[:, j], self.n_centroids, seed=self.seed)[0] for j in range(self.n_subspaces)])
+        return self
+
+    def encode(self, embeds: np.ndarray) -> np.ndarray:
+
+        subspaces = self._split(embeds)
+        codes = np.empty((len(embeds), self.n_subspaces), dtype=np.uint8)
+        for j in range(self.n_subspaces):
+            codes[:, j] = assign_clusters(subspaces[:, j], self.codebooks[j])
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+
+        return np.concatenate([self.codebooks[j][codes[:, j]] for j in range(self.n_subspaces)], axis=1)
+
+    def lookup_tables(self, queries: np.ndarray) -> np.ndarray:
+
+        return np.einsum("qmd,mcd->qmc", self._split(queries), self.codebooks)
+
+    def adc_scores(self, queries: np.ndarray, codes: np.ndarray, owners: np.ndarray) -> np.ndarray:
+
+        tables = self.lookup_tables(queries)
+        return tables[owners[:, None], np.arange(self.n_subspaces)[None, :], codes].sum(axis=1)
+
+    def save(self, path: str):
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez(path, codebooks=self.codebooks, seed=self.seed)
+
+    @classmethod
+    def load(cls, path: str):
+
+        data = np.load(path)
+        codebooks = data["codebooks"]
+        pq = cls(n_subspaces=codebooks.shape[0], n_centroids=codebooks.shape[1], seed=int(data["seed"]))
+        pq.codebooks = codebooks
+        return pq
+
+
+def compressed_nbytes(num_docs: int, dim: int, compression: str = None, n_subspaces: int = 16) -> int:
+
+    if compression == "fp16":
+        return num_docs * dim * 2
+    elif compression == "pq":
+        return num_docs * n_subspaces
+    return num_docs * dim * 4
@@ -0,0 +1,76 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+
+class ResponseCache:
+
+    def __init__(self, path: str = os.path.join("files", "response_cache.sqlite"), max_size_mb: float = 1024):
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, size INTEGER, last_access REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self.conn.commit()
+        self.total_size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(repo_id: str, gen_params: dict, messages) -> str:
+
+        payload = json.dumps([repo_id, gen_params, messages], sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+
+        row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+        self.conn.commit()
+        return row[0]
+
+    def put(self, key: str, response: str):
+
+        if not isinstance(response, str):
+            return
+        size = len(key) + len(response.encode("utf-8"))
+        old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, response, size, time.time()))
+        self.total_size += size - (old[0] if old else 0)
+        if self.total_size > self.max_size:
+            self.evict()
+        self.conn.commit()
+
+    def evict(self, target_ratio: float = 0.9):
+
+        target_size = int(self.max_size * target_ratio)
+        num_evicted = 0
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY last_access ASC").fetchall():
+            if self.total_size <= target_size:
+                break
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.total_size -= size
+            num_evicted += 1
+        self.conn.commit()
+        print(f"Evicted {num_evicted} responses from the response cache!")
+
+    def __len__(self):
+
+        return self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def stats(self) -> dict:
+
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self), "size_mb": round(self.total_size / (1024 * 1024), 2)}
+
+    def close(self):
+
+        self.conn.close()
@@ -0,0 +1,100 @@
+import os
+import json
+
+import numpy as np
+from typing import List
+
+
+class RetrievalCache:
+
+    def __init__(self, path_prefix: str, k_max: int):
+
+        self.path_prefix = path_prefix
+        self.idx_path = f"{path_prefix}.idx"
+        self.score_path = f"{path_prefix}.scores"
+        self.offset_path = f"{path_prefix}.offsets"
+        self.meta_path = f"{path_prefix}.meta.json"
+        self.k_max = k_max
+        self._idxs = None
+        self._scores = None
+        self._offsets = None
+
+        if all(os.path.exists(path) for path in [self.meta_path, self.idx_path, self.score_path, self.offset_path]):
+            with open(self.meta_path, "r") as f:
+                cached_k_max = json.load(f)["k_max"]
+            if cached_k_max < k_max:
+                print(f"Cached retrieval results only hold top-{cached_k_max}, starting from 0!")
+                self.reset()
+            else:
+                self.k_max = cached_k_max
+        else:
+            self.reset()
+
+    def reset(self):
+
+        for path in [self.idx_path, self.score_path, self.offset_path]:
+            open(path, "wb").close()
+        with open(self.meta_path, "w") as f:
+            json.dump({"k_max": self.k_max}, f)
+        self._idxs = self._scores = self._offsets = None
+
+    def _load(self):
+
+        if self._offsets is not None:
+            return
+        offsets = np.fromfile(self.offset_path, dtype=np.int64, count=os.path.getsize(self.offset_path) // 8)
+        num_entries = min(os.path.getsize(self.idx_path) // 4, os.path.getsize(self.score_path) // 2)
+        offsets = offsets[:np.searchsorted(offsets, num_entries, side="right")]
+        self._offsets = np.concatenate([[0], offsets]).astype(np.int64)
+        num_entries = int(self._offsets[-1])
+        for path, num_bytes in [(self.idx_path, num_entries * 4), (self.score_path, num_entries * 2), (self.offset_path, len(offsets) * 8)]:
+            if os.path.getsize(path) != num_bytes:
+                with open(path, "ab") as f:
+                    f.truncate(num_bytes)
+        if num_entries > 0:
+            self._idxs = np.memmap(self.idx_path, dtype=np.int32, mode="r", shape=(num_entries,))
+            self._scores = np.memmap(self.score_path, dtype=np.float16, mode="r", shape=(num_entries,))
+        else:
+            self._idxs = np.zeros(0, dtype=np.int32)
+            self._scores = np.zeros(0, dtype=np.float16)
+
+    def __len__(self):
+
+        self._load()
+        return len(self._offsets) - 1
+
+    def row_lengths(self) -> np.ndarray:
+
+        self._load()
+        return np.diff(self._offsets)
+
+    def get(self, i: int):
+
+        self._load()
+        start, end = self._offsets[i], self._offsets[i+1]
+        return self._idxs[start:end], self._scores[start:end]
+
+    def append(self, all_idxs: List[List[int]], all_scores: List[List[float]] = None):
+
+        self._load()
+        if all_scores is None:
+            all_scores = [[np.nan] * len(idxs) for idxs in all_idxs]
+        all_idxs = [np.asarray(idxs[:self.k_max], dtype=np.int32) for idxs in all_idxs]
+        all_scores = [np.asarray(scores[:self.k_max], dtype=np.float16) for scores in all_scores]
+        ends = self._offsets[-1] + np.cumsum([len(idxs) for idxs in all_idxs])
+
+        with open(self.idx_path, "ab") as f:
+            f.write(np.concatenate(all_idxs).astype(np.int32).tobytes() if all_idxs else b"")
+        with open(self.score_path, "ab") as f:
+            f.write(np.concatenate(all_scores).astype(np.float16).tobytes() if all_scores else b"")
+        with open(self.offset_path, "ab") as f:
+            f.write(ends.astype(np.int64).tobytes())
+        self._idxs = self._scores = self._offsets = None
+
+    def import_json(self, json_path: str):
+
+        with open(json_path, "r") as f:
+            all_idxs = json.load(f)
+        self.reset()
+        self.append(all_idxs)
+        print(f"Converted {len(all_idxs)} cached retrieval results from {json_path}!")
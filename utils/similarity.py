@@ -0,0 +1,60 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import sparse
+
+
+class SimilarityEngine:
+
+    def __init__(self, block_size: int = 1024, num_threads: int = 1):
+
+        self.block_size = block_size
+        self.num_threads = num_threads
+
+    def _run_blocks(self, num_rows: int, fn):
+
+        starts = range(0, num_rows, self.block_size)
+        if self.num_threads > 1:
+            with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+                list(executor.map(fn, starts))
+        else:
+            for start in starts:
+                fn(start)
+
+    def topk(self, queries: np.ndarray, corpus: np.ndarray, k: int = None, largest: bool = True):
+
+        single = queries.ndim == 1
+        if single:
+            queries = queries[None, :]
+        k = corpus.shape[0] if k is None else min(k, corpus.shape[0])
+        all_idxs = np.empty((queries.shape[0], k), dtype=np.int64)
+        all_scores = np.empty((queries.shape[0], k), dtype=np.float32)
+
+        def process_block(start):
+            sims = queries[start:start+self.block_size] @ corpus.T
+            if sparse.issparse(sims):
+                sims = sims.toarray()
+            keys = -sims if largest else sims
+            if k < sims.shape[1]:
+                part = np.argpartition(keys, k-1, axis=1)[:, :k]
+            else:
+                part = np.broadcast_to(np.arange(sims.shape[1]), sims.shape)
+            order = np.argsort(np.take_along_axis(keys, part, axis=1), axis=1, kind="stable")
+            idxs = np.take_along_axis(part, order, axis=1)
+            all_idxs[start:start+len(idxs)] = idxs
+            all_scores[start:start+len(idxs)] = np.take_along_axis(sims, idxs, axis=1)
+
+        self._run_blocks(queries.shape[0], process_block)
+        if single:
+            return all_idxs[0], all_scores[0]
+        return all_idxs, all_scores
+
+    def row_sums(self, queries: np.ndarray, corpus: np.ndarray) -> np.ndarray:
+
+        sums = np.empty(queries.shape[0], dtype=np.float32)
+
+        def process_block(start):
+            sums[start:start+self.block_size] = (queries[start:start+self.block_size] @ corpus.T).sum(axis=1)
+
+        self._run_blocks(queries.shape[0], process_block)
+        return sums
@@ -0,0 +1,62 @@
+import os
+import re
+import json
+import math
+
+import numpy as np
+from typing import List
+
+WORD_PATTERN = re.compile(r"\w+")
+SYMBOL_PATTERN = re.compile(r"[^\w\s]")
+
+DEFAULT_COEFS = {
+    "CLAUDE": [0.12, 0.55, 0.9, 0.5],
+    "GEMINI": [0.1, 0.5, 0.8, 0.4],
+}
+
+
+def text_features(text: str) -> np.ndarray:
+
+    num_chars = len(text)
+    num_non_ascii = sum(1 for char in text if ord(char) > 127)
+    return np.array([num_chars, len(WORD_PATTERN.findall(text)), len(SYMBOL_PATTERN.findall(text)), num_non_ascii], dtype=np.float64)
+
+
+class TokenEstimator:
+
+    def __init__(self, family: str, safety_margin: float = 0.1, calib_dir: str = os.path.join("files", "token_calibration")):
+
+        self.family = family
+        self.safety_margin = safety_margin
+        self.calib_path = os.path.join(calib_dir, f"{family}.json")
+        self.coefs = np.array(DEFAULT_COEFS.get(family, DEFAULT_COEFS["CLAUDE"]))
+        self.is_calibrated = False
+        if os.path.exists(self.calib_path):
+            with open(self.calib_path, "r") as f:
+                self.coefs = np.array(json.load(f)["coefs"])
+            self.is_calibrated = True
+
+    def estimate(self, text: str) -> int:
+
+        return int(math.ceil(float(text_features(text) @ self.coefs) * (1 + self.safety_margin)))
+
+    def calibrate(self, texts: List[str], counts: List[int]) -> dict:
+
+        features = np.stack([text_features(text) for text in texts])
+        counts = np.asarray(counts, dtype=np.float64)
+        coefs, _, _, _ = np.linalg.lstsq(features, counts, rcond=None)
+        self.coefs = np.clip(coefs, 0, None)
+        estimates = features @ self.coefs
+        rel_errors = (estimates - counts) / np.maximum(counts, 1)
+        report = {
+            "coefs": self.coefs.tolist(),
+            "num_samples": len(texts),
+            "mean_abs_rel_error": float(np.abs(rel_errors).mean()),
+            "max_under_rel_error": float(max(0, -rel_errors.min())),
+        }
+        os.makedirs(os.path.dirname(self.calib_path), exist_ok=True)
+        with open(self.calib_path, "w") as f:
+            json.dump(report, f)
+        self.is_calibrated = True
+        print(f"Calibrated {self.family} token estimator on {len(texts)} texts, mean relative error: {report['mean_abs_rel_error']:.4f}, max underestimate: {report['max_under_rel_error']:.4f}")
+        return report